@@ -3,13 +3,50 @@
 电子书下载器 - 使用 macOS 原生对话框
 """
 
+import argparse
 import subprocess
 import urllib.request
 import urllib.parse
+import urllib.error
+import array
+import bisect
+import codecs
+import collections.abc
+import functools
+import hashlib
+import heapq
+import html
+import http.client
+import io
 import json
+import mmap
 import os
 import re
+import shutil
+import ssl
 import sys
+import threading
+import time
+import unicodedata
+import xml.etree.ElementTree as ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# 可选依赖：安装后分别用于拼音匹配和更完整的繁简转换
+try:
+    import pypinyin
+except ImportError:
+    pypinyin = None
+try:
+    import opencc
+except ImportError:
+    opencc = None
+# 命令行边输入边搜索需要逐字读取终端输入，Windows 上没有
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = tty = None
 
 def run_applescript(script):
     """执行 AppleScript 并返回结果"""
@@ -93,6 +130,19 @@ def choose_save_location(filename):
     result, success = run_applescript(script)
     return result if success else None
 
+def choose_folder(message):
+    """选择文件夹"""
+    downloads = os.path.expanduser("~/Downloads")
+    script = f'''
+    tell application "System Events"
+        activate
+        set folderPath to choose folder with prompt "{message}" default location POSIX file "{downloads}"
+        return POSIX path of folderPath
+    end tell
+    '''
+    result, success = run_applescript(script)
+    return result if success else None
+
 # 已知的电子书仓库列表
 KNOWN_EBOOK_REPOS = [
     "fancy88/iBook",
@@ -112,104 +162,1707 @@ KNOWN_EBOOK_REPOS = [
     "woai3c/recommended-books",
 ]
 
-def create_progress_html(book_name):
-    """创建进度显示 HTML 文件"""
-    html_path = '/tmp/book_search_progress.html'
-    html_content = f'''
-<!DOCTYPE html>
+GITHUB_API = "https://api.github.com"
+
+# 本地缓存目录
+if sys.platform == 'darwin':
+    _DEFAULT_CACHE_DIR = '~/Library/Caches/BookDownloader'
+else:
+    _DEFAULT_CACHE_DIR = '~/.cache/BookDownloader'
+CACHE_DIR = os.path.expanduser(os.environ.get('BOOK_DOWNLOADER_CACHE', _DEFAULT_CACHE_DIR))
+TREE_CACHE_DIR = os.path.join(CACHE_DIR, 'trees')
+
+# 缓存在此时间（秒）内直接使用，不发任何请求；过期后用 ETag 做条件请求
+TREE_CACHE_TTL = int(os.environ.get('BOOK_DOWNLOADER_CACHE_TTL', '600'))
+# 树缓存总大小上限，超出后按最近最少使用淘汰
+TREE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TREE_CACHE_VERSION = 2
+
+_tree_cache_lock = threading.Lock()
+
+def _temp_path(path):
+    """写入 path 前使用的临时文件名；图形界面和后台预取进程可能同时写同一个缓存，进程号和线程号都要区分"""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+# 结果数量上限，达到后提前结束扫描
+MAX_RESULTS = 20
+
+# 同时扫描的仓库数量，可通过环境变量调整
+SCAN_WORKERS = int(os.environ.get('BOOK_DOWNLOADER_WORKERS', '6'))
+
+# 每个主机最多保留的空闲长连接数
+POOL_MAX_IDLE_PER_HOST = 8
+# 最多跟随的重定向次数
+MAX_REDIRECTS = 5
+# 关闭响应时剩余正文不超过此大小则读完，以便复用连接
+_DRAIN_LIMIT = 64 * 1024
+
+class PooledResponse:
+    """连接池中的 HTTP 响应，关闭时把仍可复用的连接归还连接池"""
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        if self._conn is None:
+            return
+        response = self._response
+        try:
+            if not response.isclosed() and response.length is not None \
+                    and response.length <= _DRAIN_LIMIT:
+                response.read()
+        except (OSError, http.client.HTTPException):
+            pass
+        if response.isclosed() and not response.will_close:
+            self._pool.release(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ConnectionPool:
+    """按主机复用 HTTP/HTTPS 长连接，所有线程共享
+
+    空闲连接按 (协议, 主机) 保存；被服务器关闭的空闲连接在重用失败时自动重连一次。
+    """
+
+    def __init__(self, max_idle_per_host=POOL_MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def _new_connection(self, scheme, netloc, timeout):
+        proxy = urllib.request.getproxies().get(scheme)
+        host = netloc.rsplit('@', 1)[-1]
+        if proxy and not urllib.request.proxy_bypass(host.split(':')[0]):
+            proxy_netloc = urllib.parse.urlsplit(proxy).netloc or proxy
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(proxy_netloc, timeout=timeout,
+                                                   context=self._ssl_context)
+                conn.set_tunnel(host)
+                return conn
+            return http.client.HTTPConnection(proxy_netloc, timeout=timeout)
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(host, timeout=timeout)
+
+    def acquire(self, key, timeout):
+        """取出一个空闲连接，没有时新建；返回 (连接, 是否为复用连接)"""
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        return self._new_connection(key[0], key[1], timeout), False
+
+    def release(self, key, conn):
+        """归还可复用的连接"""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """关闭所有空闲连接"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, url, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        if urllib.request.getproxies().get(parts.scheme) and parts.scheme == 'http' \
+                and not urllib.request.proxy_bypass(parts.hostname or ''):
+            target = url
+        while True:
+            conn, reused = self.acquire(key, timeout)
+            try:
+                conn.request('GET', target, headers=headers)
+                response = conn.getresponse()
+                return PooledResponse(self, key, conn, response, url)
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError, http.client.BadStatusLine):
+                conn.close()
+                # 空闲连接可能已被服务器关闭，换新连接重试一次
+                if not reused:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    def open(self, url, headers=None, timeout=15):
+        """发送 GET 请求并跟随重定向；与 urlopen 一样，状态码不低于 300 时抛出 HTTPError"""
+        headers = dict(headers or {})
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._send(url, headers, timeout)
+            location = response.headers.get('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.close()
+                new_url = urllib.parse.urljoin(url, location)
+                if urllib.parse.urlsplit(new_url).netloc != urllib.parse.urlsplit(url).netloc:
+                    # 不把凭据带到其他主机
+                    headers.pop('Authorization', None)
+                url = new_url
+                continue
+            if response.status >= 300:
+                try:
+                    body = response.read()
+                finally:
+                    response.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.headers, io.BytesIO(body))
+            return response
+        raise urllib.error.HTTPError(url, response.status, "重定向次数过多",
+                                     response.headers, None)
+
+# 剩余 API 配额不超过此数时，有缓存的仓库直接使用旧缓存，把配额留给没有缓存的仓库
+RATE_LIMIT_RESERVE = 10
+# 配额用完时最多等待窗口重置的秒数，超过则抛出 RateLimitError
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('BOOK_DOWNLOADER_RATE_WAIT', '60'))
+
+class RateLimitError(Exception):
+    """GitHub API 配额已用完"""
+
+    def __init__(self, reset):
+        self.reset = reset
+        if reset == float('inf'):
+            # 所有令牌都已失效，配额不会自动恢复
+            super().__init__("GitHub API 令牌均已失效")
+        else:
+            super().__init__(
+                f"GitHub API 配额已用完，将于 {time.strftime('%H:%M', time.localtime(reset))} 重置")
+
+class RateLimiter:
+    """根据 X-RateLimit-* 响应头跟踪单个令牌（或匿名访问）的 GitHub API 配额"""
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = 0
+        self._lock = threading.Lock()
+
+    def update(self, status, headers):
+        """用响应头更新配额；被限流的 403/429 响应视为配额用完"""
+        with self._lock:
+            remaining = headers.get('X-RateLimit-Remaining')
+            if remaining is not None:
+                self.remaining = int(remaining)
+                self.limit = int(headers.get('X-RateLimit-Limit', self.limit or 0))
+                self.reset = int(headers.get('X-RateLimit-Reset', self.reset))
+            retry_after = headers.get('Retry-After')
+            if status in (403, 429) and (retry_after or self.remaining == 0):
+                self.remaining = 0
+                if retry_after:
+                    self.reset = max(self.reset, time.time() + int(retry_after))
+
+    def disable(self):
+        """令牌无效时不再使用"""
+        with self._lock:
+            self.remaining = 0
+            self.reset = float('inf')
+
+    def available(self):
+        """当前可用配额，未知时为无穷大"""
+        with self._lock:
+            if self.remaining is None or self.reset <= time.time():
+                return float('inf')
+            return self.remaining
+
+    def try_acquire(self):
+        """预扣一次配额，成功返回 True，配额用完返回 False"""
+        with self._lock:
+            if self.remaining is not None and self.reset <= time.time():
+                # 窗口已重置，等下一次响应告知新的配额
+                self.remaining = None
+            if self.remaining is None:
+                return True
+            if self.remaining > 0:
+                self.remaining -= 1
+                return True
+            return False
+
+    def status(self):
+        """返回 {'limit', 'remaining', 'reset'}，尚未收到响应时为 None"""
+        with self._lock:
+            return {'limit': self.limit, 'remaining': self.remaining, 'reset': self.reset}
+
+CONFIG_PATH = os.path.expanduser(
+    os.environ.get('BOOK_DOWNLOADER_CONFIG', '~/.config/BookDownloader/config.json'))
+
+def load_config():
+    """读取配置文件，不存在时返回空配置"""
+    try:
+        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_tokens():
+    """收集 GitHub API 令牌：环境变量 BOOK_DOWNLOADER_TOKENS（逗号分隔）、
+    GITHUB_TOKEN，以及配置文件中的 tokens 列表"""
+    tokens = []
+    for name in ('BOOK_DOWNLOADER_TOKENS', 'GITHUB_TOKEN'):
+        tokens.extend(t.strip() for t in os.environ.get(name, '').split(','))
+    tokens.extend(load_config().get('tokens', []))
+    unique = []
+    for token in tokens:
+        if token and token not in unique:
+            unique.append(token)
+    return unique
+
+class TokenPool:
+    """在多个令牌之间分配 API 请求
+
+    每次请求选择剩余配额最多的令牌，配额相同时轮流使用；没有令牌时匿名访问。
+    所有令牌的配额都用完时排队等到最早的窗口重置，等待时间超过上限则抛出 RateLimitError。
+    """
+
+    def __init__(self, tokens=None):
+        self.limiters = {token: RateLimiter() for token in tokens or []} or {None: RateLimiter()}
+        self._turn = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait=None):
+        """选出一个令牌并预扣一次配额，返回令牌（匿名时为 None）"""
+        max_wait = RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        while True:
+            with self._lock:
+                self._turn += 1
+                tokens = list(self.limiters)
+                shift = self._turn % len(tokens)
+                tokens = tokens[shift:] + tokens[:shift]
+            tokens.sort(key=lambda token: self.limiters[token].available(), reverse=True)
+            for token in tokens:
+                if self.limiters[token].try_acquire():
+                    return token
+            reset = self.reset
+            wait_time = reset - time.time()
+            if wait_time > max_wait or reset == float('inf'):
+                raise RateLimitError(reset)
+            time.sleep(max(wait_time, 0) + 1)
+
+    def wait_for_reset(self, max_wait=None):
+        """等到最早的配额窗口重置，返回 True；需要等待的时间超过上限（或配额不会恢复）时立即返回 False"""
+        max_wait = RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        reset = self.reset
+        wait_time = reset - time.time()
+        if reset == float('inf') or wait_time > max_wait:
+            return False
+        time.sleep(max(wait_time, 0) + 1)
+        return True
+
+    def update(self, token, status, headers):
+        """用响应头更新令牌的配额；令牌无效（401）时停用，全部停用后改为匿名访问"""
+        limiter = self.limiters.get(token)
+        if limiter is None:
+            return
+        if status == 401 and token is not None:
+            limiter.disable()
+            with self._lock:
+                if None not in self.limiters and all(
+                        item.status()['reset'] == float('inf') for item in self.limiters.values()):
+                    # 整体替换字典，其他线程遍历旧字典时不受影响
+                    self.limiters = {**self.limiters, None: RateLimiter()}
+        else:
+            limiter.update(status, headers)
+
+    @property
+    def reset(self):
+        """最早恢复配额的时间"""
+        return min(limiter.status()['reset'] for limiter in self.limiters.values())
+
+    def low(self, reserve=RATE_LIMIT_RESERVE):
+        """所有令牌的剩余配额合计是否不超过 reserve"""
+        return sum(min(limiter.available(), reserve + 1)
+                   for limiter in self.limiters.values()) <= reserve
+
+    def exhausted(self):
+        """所有令牌的配额是否都已用完"""
+        return self.low(0)
+
+    def status(self):
+        """返回所有令牌合计的 {'limit', 'remaining', 'reset', 'tokens'}，配额未知时为 None"""
+        statuses = [limiter.status() for limiter in self.limiters.values()]
+        known = all(item['remaining'] is not None for item in statuses)
+        return {
+            'limit': sum(item['limit'] for item in statuses) if known else None,
+            'remaining': sum(item['remaining'] for item in statuses) if known else None,
+            'reset': min(item['reset'] for item in statuses),
+            'tokens': len([token for token in self.limiters if token]),
+        }
+
+_token_pool = TokenPool(load_tokens())
+
+def get_rate_limit():
+    """当前 GitHub API 剩余配额（所有令牌合计），供调用方决定是否继续大量请求"""
+    return _token_pool.status()
+
+# 扫描与下载共用的连接池
+_connection_pool = ConnectionPool()
+
+def open_url(url, headers=None, timeout=15):
+    """通过共享连接池打开 URL，自动附加通用请求头"""
+    all_headers = {"User-Agent": "BookDownloader/1.0"}
+    if url.startswith(GITHUB_API):
+        all_headers["Accept"] = "application/vnd.github.v3+json"
+    all_headers.update(headers or {})
+    if not url.startswith(GITHUB_API):
+        return _connection_pool.open(url, all_headers, timeout)
+    
+    token = _token_pool.acquire()
+    if token:
+        all_headers["Authorization"] = f"token {token}"
+    try:
+        response = _connection_pool.open(url, all_headers, timeout)
+    except urllib.error.HTTPError as e:
+        _token_pool.update(token, e.code, e.headers)
+        if e.code == 401 and token:
+            # 令牌已停用，换下一个令牌（全部失效时匿名）重试
+            return open_url(url, headers, timeout)
+        if e.code in (403, 429) and _token_pool.exhausted():
+            raise RateLimitError(_token_pool.reset) from e
+        raise
+    _token_pool.update(token, response.status, response.headers)
+    return response
+
+def _cache_key(name):
+    """把仓库或搜索源名称转换为可用作文件名的键"""
+    return re.sub(r'[^\w.-]', '_', name.replace('/', '__'))
+
+def _tree_cache_path(repo_name):
+    """仓库对应的缓存文件路径"""
+    return os.path.join(TREE_CACHE_DIR, _cache_key(repo_name) + '.json')
+
+def load_cached_tree(repo_name):
+    """读取仓库的缓存树，没有或格式过期时返回 None"""
+    path = _tree_cache_path(repo_name)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            record = json.load(f)
+        if record.get('version') != TREE_CACHE_VERSION or record.get('formats') != EBOOK_FORMATS:
+            return None
+        # 更新访问时间，用于 LRU 淘汰
+        os.utime(path, None)
+        return record
+    except (OSError, ValueError):
+        return None
+
+def save_cached_tree(record):
+    """写入缓存树并按大小上限淘汰旧缓存"""
+    path = _tree_cache_path(record['repo'])
+    record['version'] = TREE_CACHE_VERSION
+    try:
+        os.makedirs(TREE_CACHE_DIR, exist_ok=True)
+        tmp_path = _temp_path(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError:
+        return
+    evict_tree_cache()
+
+def evict_tree_cache(max_bytes=TREE_CACHE_MAX_BYTES):
+    """删除最久未使用的缓存，直到总大小不超过上限"""
+    _evict_lru(TREE_CACHE_DIR, max_bytes, ('.json',))
+
+def _evict_lru(directory, max_bytes, suffixes=None, keep=None):
+    """按修改时间（读取时会更新）删除目录（含子目录）中最久未使用的文件，直到总大小不超过上限
+
+    suffixes 为参与淘汰的文件扩展名，None 表示除临时文件外的全部文件；
+    keep 为刚写入的文件路径，不会被删除。
+    """
+    with _tree_cache_lock:
+        files = []
+        for dirpath, _, names in os.walk(directory):
+            for name in names:
+                if name.endswith('.tmp') or (suffixes and not name.endswith(suffixes)):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+# 流式解析树 JSON 时每次读取的字节数
+TREE_CHUNK_SIZE = 64 * 1024
+
+# 支持的电子书格式，按偏好从高到低排列；可用环境变量 BOOK_DOWNLOADER_FORMATS
+# （逗号分隔）或配置文件中的 formats 列表修改
+DEFAULT_EBOOK_FORMATS = ['.epub', '.pdf', '.mobi', '.azw3', '.azw', '.djvu']
+
+def _configured_formats():
+    """读取配置的格式列表，统一为带点的小写扩展名"""
+    formats = os.environ.get('BOOK_DOWNLOADER_FORMATS', '').split(',')
+    if not any(f.strip() for f in formats):
+        formats = load_config().get('formats') or DEFAULT_EBOOK_FORMATS
+    return normalize_formats(formats)
+
+def normalize_formats(formats):
+    """把 'pdf'、'.PDF' 等写法统一为 '.pdf'，去掉重复项并保持顺序"""
+    result = []
+    for fmt in formats:
+        fmt = fmt.strip().lower()
+        if fmt and not fmt.startswith('.'):
+            fmt = '.' + fmt
+        if fmt and fmt not in result:
+            result.append(fmt)
+    return result
+
+EBOOK_FORMATS = _configured_formats()
+# 扩展名到偏好序号的查找表，扫描树时每个条目只做一次字典查找
+_FORMAT_RANK = {fmt: rank for rank, fmt in enumerate(EBOOK_FORMATS)}
+
+_TREE_START_RE = re.compile(r'"tree"\s*:\s*\[')
+_TRUNCATED_RE = re.compile(r'"truncated"\s*:\s*(true|false)')
+
+def ebook_format(path):
+    """返回路径的电子书格式（如 '.pdf'），不是支持的格式时返回 None"""
+    fmt = os.path.splitext(path)[1].lower()
+    return fmt if fmt in _FORMAT_RANK else None
+
+def is_ebook_entry(item):
+    """树条目是否为支持格式的电子书文件"""
+    return item.get('type') == 'blob' and ebook_format(item.get('path', '')) is not None
+
+def iter_tree_entries(response, predicate=None, meta=None, chunk_size=TREE_CHUNK_SIZE):
+    """分块读取 git 树 JSON，逐个产出 tree 数组中符合条件的条目
+
+    不把整个响应读入内存，只缓存尚未解析完的一小段文本。
+    解析结束后 meta['truncated'] 记录 GitHub 是否截断了结果。
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    head = ''
+    buf = ''
+    in_tree = False
+    tree_done = False
+    while True:
+        chunk = response.read(chunk_size)
+        buf += text_decoder.decode(chunk, final=not chunk)
+
+        if not in_tree and not tree_done:
+            match = _TREE_START_RE.search(buf)
+            if match:
+                head = buf[:match.start()]
+                buf = buf[match.end():]
+                in_tree = True
+
+        if in_tree:
+            pos = 0
+            length = len(buf)
+            while True:
+                while pos < length and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos >= length:
+                    break
+                if buf[pos] == ']':
+                    in_tree = False
+                    tree_done = True
+                    pos += 1
+                    break
+                try:
+                    item, pos_end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # 条目还没有接收完整，等待下一块
+                    break
+                pos = pos_end
+                if predicate is None or predicate(item):
+                    yield item
+            buf = buf[pos:]
+
+        if not chunk:
+            break
+
+    if not tree_done:
+        raise ValueError("无效的 git 树响应")
+    if meta is not None:
+        match = _TRUNCATED_RE.search(head + buf)
+        meta['truncated'] = bool(match) and match.group(1) == 'true'
+
+def _compact_entry(item, prefix=''):
+    """只保留缓存需要的字段"""
+    return {'path': prefix + item['path'], 'sha': item.get('sha'), 'size': item.get('size')}
+
+# 树被截断时同时获取的子树数量
+SUBTREE_WORKERS = 8
+
+# 不会存放电子书的目录，逐层展开时直接跳过
+PRUNED_DIRS = {
+    '.git', '.github', '__pycache__', 'node_modules', 'vendor',
+    'assets', 'static', 'images', 'image', 'img', 'imgs', 'pics',
+    'screenshots', 'css', 'js', 'fonts',
+}
+
+def _fetch_subtree(repo_name, tree_sha, prefix):
+    """递归获取一棵子树中的电子书条目
+
+    返回 (条目列表, 待展开的子目录列表)。递归结果未被截断时子目录列表为空；
+    被截断时丢弃不完整的结果，只返回这一层的文件和子目录。
+    """
+    meta = {}
+    url = f"{GITHUB_API}/repos/{repo_name}/git/trees/{tree_sha}?recursive=1"
+    with open_url(url) as response:
+        entries = [_compact_entry(item, prefix)
+                   for item in iter_tree_entries(response, is_ebook_entry, meta)]
+    if not meta['truncated']:
+        return entries, []
+
+    url = f"{GITHUB_API}/repos/{repo_name}/git/trees/{tree_sha}"
+    with open_url(url) as response:
+        children = list(iter_tree_entries(
+            response, lambda item: item.get('type') == 'tree' or is_ebook_entry(item)))
+    entries = []
+    subtrees = []
+    for item in children:
+        if item['type'] != 'tree':
+            entries.append(_compact_entry(item, prefix))
+        elif item['path'].lower() not in PRUNED_DIRS:
+            subtrees.append((item['sha'], prefix + item['path'] + '/'))
+    return entries, subtrees
+
+def fetch_tree_entries(repo_name, tree_sha, max_workers=SUBTREE_WORKERS):
+    """获取树中所有电子书条目
+
+    先尝试一次递归获取；结果被截断时按层广度优先展开，同一层的子树并发获取，
+    每棵子树仍优先递归获取，只有再次被截断才继续向下展开。
+    """
+    entries, level = _fetch_subtree(repo_name, tree_sha, '')
+    if not level:
+        return entries
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while level:
+            next_level = []
+            for sub_entries, subtrees in executor.map(
+                    lambda subtree: _fetch_subtree(repo_name, *subtree), level):
+                entries.extend(sub_entries)
+                next_level.extend(subtrees)
+            level = next_level
+    return entries
+
+# 比较 API 最多列出的文件数，达到时列表可能不完整，改为重新获取整棵树
+COMPARE_MAX_FILES = 300
+
+def fetch_tree_delta(repo_name, cached, commit):
+    """用比较 API 把缓存树更新到新提交，只处理新增、删除、改名和修改的电子书
+
+    返回新的条目列表；新提交不是旧提交的后续（如强制推送）、变化的文件太多
+    或请求失败时返回 None，由调用方重新获取整棵树。
+    比较结果中没有文件大小，新增和修改的条目 size 为 None。
+    """
+    url = f"{GITHUB_API}/repos/{repo_name}/compare/{cached['commit']}...{commit}"
+    try:
+        with open_url(url, timeout=30) as response:
+            data = json.loads(response.read().decode('utf-8'))
+    except RateLimitError:
+        raise
+    except Exception:
+        return None
+    files = data.get('files') or []
+    if data.get('status') not in ('ahead', 'identical') or len(files) >= COMPARE_MAX_FILES:
+        return None
+
+    tree = {item['path']: item for item in cached['tree']}
+    for change in files:
+        if change.get('previous_filename'):
+            tree.pop(change['previous_filename'], None)
+        if change.get('status') == 'removed':
+            tree.pop(change['filename'], None)
+        elif ebook_format(change['filename']):
+            tree[change['filename']] = {'path': change['filename'], 'sha': change.get('sha'), 'size': None}
+    return list(tree.values())
+
+def fetch_repo_tree(repo_name, max_age=TREE_CACHE_TTL):
+    """获取仓库中的电子书文件列表，优先使用本地缓存
+
+    缓存以仓库和 HEAD 提交 SHA 为键。过期后先用 If-None-Match 检查 HEAD，
+    返回 304 时不消耗 API 配额；提交变化时先用比较 API 只取变化的文件，
+    无法增量更新时才重新下载整棵树。
+    """
+    cached = load_cached_tree(repo_name)
+    now = time.time()
+    if cached and (now - cached.get('checked_at', 0) < max_age or _token_pool.low()):
+        # 配额紧张时继续使用旧缓存，把请求留给还没有缓存的仓库
+        return cached
+
+    headers = {"Accept": "application/vnd.github.sha"}
+    if cached and cached.get('etag'):
+        headers["If-None-Match"] = cached['etag']
+    try:
+        with open_url(f"{GITHUB_API}/repos/{repo_name}/commits/HEAD", headers) as response:
+            commit = response.read().decode('utf-8').strip()
+            etag = response.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            cached['checked_at'] = now
+            save_cached_tree(cached)
+            return cached
+        raise
+
+    if cached and cached.get('commit') == commit:
+        cached['etag'] = etag
+        cached['checked_at'] = now
+        save_cached_tree(cached)
+        return cached
+
+    tree = fetch_tree_delta(repo_name, cached, commit) if cached and cached.get('commit') else None
+    record = {
+        'repo': repo_name,
+        'commit': commit,
+        'etag': etag,
+        'checked_at': now,
+        'formats': EBOOK_FORMATS,
+        'tree': tree if tree is not None else fetch_tree_entries(repo_name, commit),
+    }
+    save_cached_tree(record)
+    return record
+
+INDEX_DIR = os.path.join(CACHE_DIR, 'index')
+INDEX_VERSION = 4
+# 索引目录总大小上限，超出后按最近最少使用淘汰（索引包含完整文件列表，比树缓存更大）
+INDEX_MAX_BYTES = 2 * TREE_CACHE_MAX_BYTES
+
+# 中日韩统一表意文字（含扩展 A 与兼容区）
+_CJK_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_WORD_RE = re.compile(r'[^\W_]+')
+
+_repo_indexes = {}
+_index_lock = threading.Lock()
+
+def split_keywords(book_name):
+    """把搜索词拆分为关键词列表，支持中英文逗号和空格"""
+    return [k.strip() for k in book_name.replace('，', ' ').replace(',', ' ').split() if k.strip()]
+
+# 常用繁体字到简体字的对照表，未安装 opencc 时使用
+_TRADITIONAL_CHARS = (
+    '書學國們來時個說為這對會經從動電開關長門問間車東華語讀寫記論讓認識話變發見觀覺親'
+    '愛與歷歲實寶當點無熱窮聖戰爭歡樂機構數據庫統計設術腦網絡資訊軟體編碼習練題試驗類'
+    '種傳詩詞曆戲劇藝漢氣風雲處陽陰島園圖畫錄鐵銀錢貨買賣價貴員務導團隊領號幾萬億專業'
+    '產農藥醫療義禮儀議選舉權歸衛證輕鬆緊細線紅綠藍黃顏頭臉飯飲魚鳥馬龍龜貓麗夢靈鬥裡'
+    '裏後麼於雖雙聽邊遠運過還進連達適遲遺邏輯輪轉軍陣陸險隨際層屬師帥帶幫廣廠應懷態憶'
+    '憂慣慶總誤課談調護評詳誰請謝譯豐貝負財責質購賽趙趕躍軌較載週鄉醜針鋼錯鍵鏡閱闆隻'
+    '難雞離頁順預頻額飛養館髮鮮麥黨齊齒劍勞勝區協卻參啟單嚴圓圍壓壞壯聲壽奪奮婦媽孫寧'
+    '將尋屆峽嶺巖幣異張強彈彎復徵戀戶擇擊擁擔擴擬攝敗敵斷晉曉條楊極樣標樹橋檢歐殺決沒'
+    '況淚淺減溫滿漁潔濟灣災烏煙燈燒營爺牆獨獲現環瑪畢瘋盡監盤眾礎確禪稱穩競筆節範築簡'
+    '籃糧紀約級納紙純組結給絕絲維緒緣縣績織繪繼續罷羅聞聯職肅脫腳膽興舊艦艱莊葉蓋蘋蘭'
+    '蟲衝裝補製複襲規視覽觸訂討訓許訴診該誕諸講謀謎譜豈豬貢販貧費貿賓賞賢賴贊贏趨跡踐'
+    '蹤輝輸辦遊違遙遷郵鄭釋釣鈔銅銷鋒鍋鎖鐘鑰閃閉閒閣陳階隱雜靜響頂項須頓顆願顧顯飽餅'
+    '駕驅驚鬧鳴鴨鷹鹽齡夠嗎讚鬱韓亞紐倫徑僅儲優僱債傷備兒兩內冊凍則創劃劉劑勵勢匯喬嘗'
+    '噸嚮壇墳壩夥奧妝娛嬰審寬屍岡帳幹廳廢彙徹慘憲懶懸撲攜斂晝暢暫朧槍樓橫檔殘毀漲潛澤'
+    '濃濕灑爐牽犧狀猶獎獸獻瓊畝癒盜盧礦祕禍稅穀窩箏簽籌糾紋終綜緩縮纖罰羨脅臨艷蕭薩蝦'
+    '螞蠟蠻襪訪詐詢誠誌謂謊譽貞賊賦賬贈軸輩轟辭遞遜鄰釀鉛銳錦鍊鍛鏈鑑鑒閩闊闡陝隸霧韋'
+    '韻頌頒頸顛飄饑騎騙騰驢髒魯鯨鶴麵黴龐誇臺樸紳貫貼賀賠軒輔轄逕鈴錶鍾閘闖韌頑頰顫颯'
+    '餘駐骯鬍魷鯊鴿鵝齋'
+)
+_SIMPLIFIED_CHARS = (
+    '书学国们来时个说为这对会经从动电开关长门问间车东华语读写记论让认识话变发见观觉亲'
+    '爱与历岁实宝当点无热穷圣战争欢乐机构数据库统计设术脑网络资讯软体编码习练题试验类'
+    '种传诗词历戏剧艺汉气风云处阳阴岛园图画录铁银钱货买卖价贵员务导团队领号几万亿专业'
+    '产农药医疗义礼仪议选举权归卫证轻松紧细线红绿蓝黄颜头脸饭饮鱼鸟马龙龟猫丽梦灵斗里'
+    '里后么于虽双听边远运过还进连达适迟遗逻辑轮转军阵陆险随际层属师帅带帮广厂应怀态忆'
+    '忧惯庆总误课谈调护评详谁请谢译丰贝负财责质购赛赵赶跃轨较载周乡丑针钢错键镜阅板只'
+    '难鸡离页顺预频额飞养馆发鲜麦党齐齿剑劳胜区协却参启单严圆围压坏壮声寿夺奋妇妈孙宁'
+    '将寻届峡岭岩币异张强弹弯复征恋户择击拥担扩拟摄败敌断晋晓条杨极样标树桥检欧杀决没'
+    '况泪浅减温满渔洁济湾灾乌烟灯烧营爷墙独获现环玛毕疯尽监盘众础确禅称稳竞笔节范筑简'
+    '篮粮纪约级纳纸纯组结给绝丝维绪缘县绩织绘继续罢罗闻联职肃脱脚胆兴旧舰艰庄叶盖苹兰'
+    '虫冲装补制复袭规视览触订讨训许诉诊该诞诸讲谋谜谱岂猪贡贩贫费贸宾赏贤赖赞赢趋迹践'
+    '踪辉输办游违遥迁邮郑释钓钞铜销锋锅锁钟钥闪闭闲阁陈阶隐杂静响顶项须顿颗愿顾显饱饼'
+    '驾驱惊闹鸣鸭鹰盐龄够吗赞郁韩亚纽伦径仅储优雇债伤备儿两内册冻则创划刘剂励势汇乔尝'
+    '吨向坛坟坝伙奥妆娱婴审宽尸冈帐干厅废汇彻惨宪懒悬扑携敛昼畅暂胧枪楼横档残毁涨潜泽'
+    '浓湿洒炉牵牺状犹奖兽献琼亩愈盗卢矿秘祸税谷窝筝签筹纠纹终综缓缩纤罚羡胁临艳萧萨虾'
+    '蚂蜡蛮袜访诈询诚志谓谎誉贞贼赋账赠轴辈轰辞递逊邻酿铅锐锦炼锻链鉴鉴闽阔阐陕隶雾韦'
+    '韵颂颁颈颠飘饥骑骗腾驴脏鲁鲸鹤面霉庞夸台朴绅贯贴贺赔轩辅辖迳铃表钟闸闯韧顽颊颤飒'
+    '余驻肮胡鱿鲨鸽鹅斋'
+)
+_T2S_TABLE = str.maketrans(_TRADITIONAL_CHARS, _SIMPLIFIED_CHARS)
+
+_t2s_converter = None
+if opencc is not None:
+    try:
+        _t2s_converter = opencc.OpenCC('t2s')
+    except Exception:
+        _t2s_converter = None
+
+# 索引内容取决于可用的规范化方式，方式变化时需要重建索引
+NORMALIZER_ID = '{}+{}'.format('opencc' if _t2s_converter else 'table',
+                               'pinyin' if pypinyin else 'nopinyin')
+
+def normalize_text(text):
+    """规范化文本：全角转半角、大小写折叠、繁体转简体"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    if _t2s_converter is not None:
+        return _t2s_converter.convert(text)
+    return text.translate(_T2S_TABLE)
+
+def pinyin_syllables(cjk_text):
+    """中文文本的拼音音节列表，未安装 pypinyin 时返回空列表"""
+    if pypinyin is None:
+        return []
+    return [syllable for syllable in pypinyin.lazy_pinyin(cjk_text) if syllable.isalpha()]
+
+# 同一目录下的文件共用目录文本，打分时反复计算，缓存最近用过的结果
+@functools.lru_cache(maxsize=65536)
+def search_text(path):
+    """用于确认匹配的文本：规范化路径，后接每段中文的全拼和拼音首字母"""
+    text = normalize_text(path)
+    forms = [text]
+    for cjk in _CJK_RE.findall(text):
+        syllables = pinyin_syllables(cjk)
+        if syllables:
+            forms.append(''.join(syllables))
+            forms.append(''.join(syllable[0] for syllable in syllables))
+    return ' '.join(forms)
+
+def _split_runs(text):
+    """把规范化后的文本切分为 (是否中文, 片段) 序列"""
+    for match in _WORD_RE.finditer(normalize_text(text)):
+        word = match.group()
+        pos = 0
+        for cjk in _CJK_RE.finditer(word):
+            if cjk.start() > pos:
+                yield False, word[pos:cjk.start()]
+            yield True, cjk.group()
+            pos = cjk.end()
+        if pos < len(word):
+            yield False, word[pos:]
+
+def index_terms(text, words=None):
+    """文档的索引词：英文单词及其每个后缀、中文单字和相邻双字
+
+    英文单词的后缀也作为索引词，这样 CleanCode、DeepLearning 这类连写的文件名
+    可以用 code、learning 前缀查找到（与逐个比较子串的结果一致）。
+    安装 pypinyin 时，中文片段的每个后缀还会以全拼和拼音首字母作为英文词加入，
+    这样拼音前缀查找可以从任意一个字开始匹配。
+    给出 words 集合时，把完整的英文单词和拼音（不含单词后缀）加入其中，供容错查找使用。
+    """
+    terms = set()
+    for is_cjk, run in _split_runs(text):
+        if is_cjk:
+            terms.update(run)
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+            syllables = pinyin_syllables(run)
+            for i in range(len(syllables)):
+                terms.add(''.join(syllables[i:]))
+                terms.add(''.join(syllable[0] for syllable in syllables[i:]))
+                if words is not None:
+                    words.add(''.join(syllables[i:]))
+        else:
+            terms.update(run[i:] for i in range(len(run)))
+            if words is not None:
+                words.add(run)
+    return terms
+
+def query_terms(keyword):
+    """关键词的查询词：英文按单词前缀匹配，中文按双字（单字时用单字）匹配
+
+    返回 (词, 是否前缀匹配) 列表。
+    """
+    terms = []
+    for is_cjk, run in _split_runs(keyword):
+        if not is_cjk:
+            terms.append((run, True))
+        elif len(run) == 1:
+            terms.append((run, False))
+        else:
+            terms.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    return terms
+
+def build_repo_index(record):
+    """根据缓存树为单个仓库构建倒排索引"""
+    paths = [item['path'] for item in record['tree']]
+    postings = {}
+    words = set()
+    for doc_id, path in enumerate(paths):
+        for term in index_terms(path, words):
+            postings.setdefault(term, []).append(doc_id)
+    return {
+        'version': INDEX_VERSION,
+        'normalizer': NORMALIZER_ID,
+        'repo': record['repo'],
+        'commit': record.get('commit'),
+        'formats': record.get('formats'),
+        'tree': record['tree'],
+        # 每个路径的规范化文本和拼音只在建索引时计算一次
+        'texts': [search_text(path) for path in paths],
+        'postings': postings,
+        # 完整的单词（不含单词后缀），容错查找只在其中进行
+        'words': sorted(words),
+    }
+
+def update_repo_index(index, record):
+    """把旧索引更新为新缓存树的索引，只为新增或内容变化的路径计算文本和索引词
+
+    未变化的文档沿用旧的规范化文本，倒排表只做编号重映射。
+    """
+    old_ids = {(item['path'], item['sha']): doc_id for doc_id, item in enumerate(index['tree'])}
+    remap = {}
+    texts = []
+    added = []
+    for doc_id, item in enumerate(record['tree']):
+        old_id = old_ids.get((item['path'], item['sha']))
+        if old_id is None:
+            added.append(doc_id)
+            texts.append(search_text(item['path']))
+        else:
+            remap[old_id] = doc_id
+            texts.append(index['texts'][old_id])
+
+    postings = {}
+    for term, ids in index['postings'].items():
+        kept = [remap[i] for i in ids if i in remap]
+        if kept:
+            postings[term] = kept
+    words = {word for word in index['words'] if word in postings}
+    for doc_id in added:
+        for term in index_terms(record['tree'][doc_id]['path'], words):
+            postings.setdefault(term, []).append(doc_id)
+    return {
+        'version': INDEX_VERSION,
+        'normalizer': NORMALIZER_ID,
+        'repo': record['repo'],
+        'commit': record.get('commit'),
+        'formats': record.get('formats'),
+        'tree': record['tree'],
+        'texts': texts,
+        'postings': postings,
+        'words': sorted(words),
+    }
+
+def _index_path(repo_name):
+    """仓库对应的索引文件路径"""
+    return os.path.join(INDEX_DIR, _cache_key(repo_name) + '.json')
+
+def _load_index_file(repo_name):
+    """从磁盘读取仓库索引"""
+    try:
+        with open(_index_path(repo_name), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') != INDEX_VERSION or index.get('normalizer') != NORMALIZER_ID:
+            return None
+        # 更新访问时间，用于 LRU 淘汰
+        os.utime(_index_path(repo_name), None)
+        return index
+    except (OSError, ValueError):
+        return None
+
+def evict_index_cache(keep=None, max_bytes=INDEX_MAX_BYTES):
+    """删除最久未使用的 JSON 索引，直到它们的总大小不超过上限
+
+    NAS 源的映射索引（.nidx）不参与淘汰：重建需要重新遍历整个目录，只在 index --rescan 时重建。
+    """
+    _evict_lru(INDEX_DIR, max_bytes, ('.json',), keep)
+
+def _save_index_file(index):
+    """把仓库索引写入磁盘"""
+    path = _index_path(index['repo'])
+    try:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        tmp_path = _temp_path(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError:
+        return
+    evict_index_cache(keep=path)
+
+def _activate_index(index):
+    """准备内存中的查询结构（有序词表用于前缀查找）"""
+    index['terms'] = sorted(index['postings'])
+    with _index_lock:
+        _repo_indexes[index['repo']] = index
+    return index
+
+def _index_matches(index, record):
+    """索引是否由这份缓存树（相同提交和格式集合）建立"""
+    return (index is not None and index['commit'] == record.get('commit')
+            and index.get('formats') == record.get('formats'))
+
+def get_repo_index(repo_name, max_age=TREE_CACHE_TTL):
+    """获取仓库（或其他建索引的搜索源）的索引"""
+    return get_source(repo_name).load_index(max_age)
+
+def tree_index(repo_name, max_age=TREE_CACHE_TTL):
+    """基于文件列表记录的索引，保存为 JSON；HEAD 提交变化时只更新该仓库的索引"""
+    with _index_lock:
+        index = _repo_indexes.get(repo_name)
+    if index and (time.time() - index.get('checked_at', 0) < max_age or _token_pool.low()):
+        return index
+
+    started = time.time()
+    record = get_source(repo_name).fetch_record(max_age)
+    if record.get('checked_at', 0) >= started:
+        # 文件列表确实重新检查过（而非直接使用未过期的缓存），记录网络耗时
+        record_repo_latency(repo_name, time.time() - started)
+    if not _index_matches(index, record):
+        previous = index
+        index = _load_index_file(repo_name)
+        if not _index_matches(index, record):
+            previous = index or previous
+            if previous is not None and previous.get('formats') == record.get('formats'):
+                # 仓库有新提交时在旧索引上增量更新
+                index = update_repo_index(previous, record)
+            else:
+                index = build_repo_index(record)
+            _save_index_file(index)
+        _activate_index(index)
+    index['checked_at'] = record.get('checked_at', 0)
+    return index
+
+def build_index(repo_list=None, max_workers=SCAN_WORKERS, rescan=False):
+    """预先为所有仓库（默认为全部建索引的搜索源）建立索引，返回成功建立索引的仓库数
+
+    rescan 为真时重新检查每个源（本地目录重新遍历），不使用已有的索引。
+    """
+    if repo_list is None:
+        repo_list = source_names(indexed_only=True)
+    built = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for index in executor.map(functools.partial(_try_get_repo_index, rescan=rescan), repo_list):
+            if index is not None:
+                built += 1
+    return built
+
+# 后台预取检查每个仓库的间隔（秒），默认为缓存有效期的一半，保证搜索时缓存总是新的
+PREFETCH_INTERVAL = float(os.environ.get('BOOK_DOWNLOADER_PREFETCH_INTERVAL', TREE_CACHE_TTL / 2))
+
+def prefetch_enabled():
+    """是否在图形界面启动时开启后台预取（环境变量 BOOK_DOWNLOADER_PREFETCH 或配置 prefetch）"""
+    value = os.environ.get('BOOK_DOWNLOADER_PREFETCH')
+    if value is not None:
+        return value.strip().lower() not in ('', '0', 'false', 'no')
+    return bool(load_config().get('prefetch'))
+
+class Prefetcher:
+    """后台预取：定期用条件请求检查各仓库的 HEAD，只下载有变化的树并更新索引
+
+    检查间隔小于缓存有效期，因此交互搜索时缓存和索引总是新的，不需要访问网络。
+    API 配额紧张时跳过本轮，把配额留给交互搜索。
+    on_update(仓库名, 索引) 在仓库提交变化、索引重建后调用。
+    """
+
+    def __init__(self, repo_list=None, interval=PREFETCH_INTERVAL, on_update=None):
+        self.repo_list = list(repo_list if repo_list is not None else source_names(indexed_only=True))
+        self.interval = interval
+        self.on_update = on_update
+        self.last_sweep = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """检查一遍所有仓库，返回提交有变化的仓库列表"""
+        changed = []
+        for repo_name in self.repo_list:
+            if self._stop.is_set() or _token_pool.low():
+                break
+            try:
+                source = get_source(repo_name)
+                # 不访问网络的本地索引（内存、JSON 文件或映射文件）作为比较基准
+                before = source.local_index()
+                # 半个间隔内已检查过（例如刚被搜索过）的仓库这一轮不再请求
+                index = source.load_index(max_age=self.interval / 2)
+            except Exception:
+                continue
+            if before is None or index['commit'] != before['commit']:
+                changed.append(repo_name)
+                if self.on_update:
+                    self.on_update(repo_name, index)
+        self.last_sweep = time.time()
+        return changed
+
+    def run_forever(self):
+        """在当前线程中循环预取，直到 stop() 被调用"""
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.refresh()
+            self._stop.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def start(self):
+        """在后台线程中开始预取"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='prefetch', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """停止预取，等待正在进行的请求结束"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+def local_index(repo_name):
+    """只使用本地已有的仓库索引，不访问网络；没有时返回 None"""
+    return get_source(repo_name).local_index()
+
+def cached_tree_index(repo_name):
+    """内存或磁盘中已有的 JSON 索引，没有时返回 None"""
+    with _index_lock:
+        index = _repo_indexes.get(repo_name)
+    if index is None:
+        index = _load_index_file(repo_name)
+        if index is not None:
+            _activate_index(index)
+    return index
+
+def _try_get_repo_index(repo_name, rescan=False):
+    """获取仓库索引，失败时返回 None"""
+    try:
+        if rescan:
+            return get_source(repo_name).rescan()
+        return get_repo_index(repo_name)
+    except Exception:
+        return None
+
+def search_index(index, keyword):
+    """在仓库索引中查找包含关键词的文件，返回文档编号集合"""
+    texts = index['texts']
+    kw_norm = normalize_text(keyword)
+    terms = query_terms(keyword)
+    if not terms:
+        # 关键词只有符号时无法走索引，退回逐个比较
+        return {i for i, text in enumerate(texts) if kw_norm in text}
+
+    candidates = None
+    for term, is_prefix in terms:
+        if is_prefix:
+            vocab = index['terms']
+            ids = set()
+            pos = bisect.bisect_left(vocab, term)
+            while pos < len(vocab) and vocab[pos].startswith(term):
+                ids.update(index['postings'][vocab[pos]])
+                pos += 1
+        else:
+            ids = set(index['postings'].get(term, ()))
+        candidates = ids if candidates is None else candidates & ids
+        if not candidates:
+            return set()
+
+    # 候选结果再确认关键词整体出现在路径（或其拼音）中
+    return {i for i in candidates if kw_norm in texts[i]}
+
+# 相关度权重：关键词出现在文件名、文件名中有近似词、只出现在目录中
+FILENAME_WEIGHT = 3.0
+FUZZY_WEIGHT = 2.0
+PATH_WEIGHT = 1.0
+# 多个关键词按原顺序连续出现在文件名中的加分，文件名与搜索词完全相同再加分
+PHRASE_BONUS = 2.0
+EXACT_BONUS = 1.0
+# 所有关键词都出现在文件名中的得分，结果全部达到此分数后可提前结束扫描
+STRONG_SCORE = FILENAME_WEIGHT
+# 格式偏好加分上限：最偏好的格式加满分，其余按顺序递减，只用于区分相关度相近的结果
+FORMAT_BONUS = 0.3
+# 英文关键词至少这么长才做容错匹配
+FUZZY_MIN_LENGTH = 4
+
+def edit_distance(a, b, max_dist):
+    """计算编辑距离（相邻字符交换算一次），超过 max_dist 时提前返回 max_dist + 1"""
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1,
+                       previous[j - 1] + (char_a != char_b))
+            if before and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > max_dist:
+            return max_dist + 1
+        before, previous = previous, current
+    return previous[-1]
+
+def _fuzzy_limit(word):
+    """英文单词允许的编辑距离，太短或不是英文单词时返回 0"""
+    if len(word) < FUZZY_MIN_LENGTH or not (word.isascii() and word.isalnum()):
+        return 0
+    return 1 if len(word) < 8 else 2
+
+def fuzzy_search_index(index, keyword):
+    """容错查找：在完整单词中寻找与关键词编辑距离很小的词，用于拼写错误
+
+    只比较完整的单词，不比较单词后缀，避免 rust 这样的词匹配到 August 的后缀 ust。
+    """
+    word = normalize_text(keyword)
+    max_dist = _fuzzy_limit(word)
+    if not max_dist:
+        return set()
+    doc_ids = set()
+    for term in index['words']:
+        if abs(len(term) - len(word)) <= max_dist and edit_distance(word, term, max_dist) <= max_dist:
+            doc_ids.update(index['postings'][term])
+    return doc_ids
+
+@functools.lru_cache(maxsize=65536)
+def _path_texts(path):
+    """打分用到的路径文本：(文件名文本, 目录文本, 文件名中的英文词, 规范化的文件名主干)"""
+    filename = search_text(os.path.basename(path))
+    filename_words = tuple(run for is_cjk, run in _split_runs(filename) if not is_cjk)
+    stem = normalize_text(os.path.splitext(os.path.basename(path))[0])
+    return filename, search_text(os.path.dirname(path)), filename_words, stem
+
+def score_path(path, keywords):
+    """计算路径与关键词的相关度
+
+    每个关键词按出现位置计分（文件名高于目录），取平均作为覆盖度；
+    多个关键词连续出现在文件名中、或文件名与搜索词完全相同时额外加分。
+    """
+    if not keywords:
+        return 0.0
+    filename, directory, filename_words, stem = _path_texts(path)
+    total = 0.0
+    for keyword in keywords:
+        word = normalize_text(keyword)
+        if word in filename:
+            total += FILENAME_WEIGHT
+            continue
+        max_dist = _fuzzy_limit(word)
+        if max_dist and any(edit_distance(word, w, max_dist) <= max_dist for w in filename_words):
+            total += FUZZY_WEIGHT
+            continue
+        if word in directory:
+            total += PATH_WEIGHT
+    score = total / len(keywords)
+
+    phrase = normalize_text(' '.join(keywords))
+    if len(keywords) > 1 and phrase in filename:
+        score += PHRASE_BONUS
+    if stem in (phrase, phrase.replace(' ', '')):
+        score += EXACT_BONUS
+    return score
+
+def _mirror(result):
+    """结果中描述单个下载来源的部分"""
+    return {'repository': result['repository'], 'path': result['path'], 'commit': result.get('commit')}
+
+class TopResults:
+    """有界最小堆，只保留得分最高的 k 个结果（k 为 0 时不限数量）
+
+    带 sha 的结果按内容去重：同一本书出现在多个仓库时合并为一个结果，
+    其余仓库记入 mirrors，不占用结果名额。
+    得分相同时先加入的结果优先，因此仓库的扫描顺序仍会影响并列结果。
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self._heap = []
+        self._by_sha = {}
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, result):
+        """加入一个带 score 的结果"""
+        sha = result.get('sha')
+        existing = self._by_sha.get(sha) if sha else None
+        if existing is not None:
+            existing['mirrors'].append(_mirror(result))
+            if result['score'] > existing['score']:
+                existing.update(name=result['name'], score=result['score'])
+                self._heap = [(r['score'], order, r) for _, order, r in self._heap]
+                heapq.heapify(self._heap)
+            return
+
+        self._count += 1
+        result = dict(result, mirrors=[_mirror(result)])
+        entry = (result['score'], -self._count, result)
+        if not self.k or len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            evicted = heapq.heapreplace(self._heap, entry)[2]
+            self._by_sha.pop(evicted.get('sha'), None)
+        else:
+            return
+        if sha:
+            self._by_sha[sha] = result
+
+    def good_enough(self):
+        """结果已满且都完整匹配了所有关键词，继续扫描不会更好"""
+        return bool(self.k) and len(self._heap) >= self.k and self._heap[0][0] >= STRONG_SCORE
+
+    def sorted(self):
+        """按得分从高到低返回结果，每个结果的镜像按可靠性排序，最可靠的作为默认来源"""
+        results = []
+        for _, _, result in sorted(self._heap, key=lambda e: e[:2], reverse=True):
+            result['mirrors'] = rank_mirrors(result['mirrors'])
+            result.update(result['mirrors'][0])
+            results.append(result)
+        return results
+
+PROGRESS_PAGE = '''<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
-    <meta http-equiv="refresh" content="1">
     <title>搜索中 - {book_name}</title>
     <style>
         body {{ font-family: -apple-system, BlinkMacSystemFont, sans-serif; 
                padding: 40px; text-align: center; background: #f5f5f7; }}
         .container {{ background: white; padding: 30px; border-radius: 12px; 
-                     box-shadow: 0 2px 10px rgba(0,0,0,0.1); max-width: 400px; margin: 0 auto; }}
+                     box-shadow: 0 2px 10px rgba(0,0,0,0.1); max-width: 480px; margin: 0 auto; }}
         h2 {{ color: #333; margin-bottom: 20px; }}
         .progress-bar {{ background: #e0e0e0; border-radius: 10px; height: 20px; overflow: hidden; }}
         .progress-fill {{ background: linear-gradient(90deg, #007aff, #5856d6); height: 100%; 
-                         transition: width 0.3s; }}
+                         width: 0%; transition: width 0.3s; }}
         .status {{ margin-top: 15px; color: #666; }}
-        .repo {{ font-size: 14px; color: #999; margin-top: 10px; }}
+        table {{ width: 100%; margin-top: 15px; font-size: 13px; color: #666; border-collapse: collapse; }}
+        td {{ padding: 3px 6px; text-align: right; }}
+        td:first-child {{ text-align: left; }}
+        .scanning {{ color: #007aff; }}
+        .failed {{ color: #ff3b30; }}
+        .hit {{ color: #34c759; font-weight: 600; }}
     </style>
 </head>
 <body>
     <div class="container">
         <h2>🔍 正在搜索: {book_name}</h2>
-        <div class="progress-bar"><div class="progress-fill" style="width: 0%"></div></div>
-        <div class="status">准备中...</div>
-        <div class="repo"></div>
+        <div class="progress-bar"><div class="progress-fill" id="fill"></div></div>
+        <div class="status" id="status">准备中...</div>
+        <table id="repos"></table>
     </div>
+    <script>
+        const rows = {{}};
+        function row(repo) {{
+            if (!rows[repo]) {{
+                const tr = document.getElementById('repos').insertRow();
+                for (let i = 0; i < 3; i++) tr.insertCell();
+                tr.cells[0].textContent = repo.split('/').pop();
+                rows[repo] = tr;
+            }}
+            return rows[repo];
+        }}
+        const source = new EventSource('/events');
+        source.onmessage = (message) => {{
+            const event = JSON.parse(message.data);
+            const status = document.getElementById('status');
+            if (event.type === 'scanning') {{
+                const tr = row(event.repo);
+                tr.className = 'scanning';
+                tr.cells[1].textContent = '扫描中';
+            }} else if (event.type === 'repo') {{
+                const tr = row(event.repo);
+                tr.className = event.error ? 'failed' : (event.hits ? 'hit' : '');
+                tr.cells[1].textContent = event.error ? '失败' : event.hits + ' 本';
+                tr.cells[2].textContent = event.elapsed_ms + ' ms';
+                const progress = Math.round(event.done / event.total * 100);
+                document.getElementById('fill').style.width = progress + '%';
+                status.textContent = `进度: ${{event.done}}/${{event.total}} (${{progress}}%) - 已找到 ${{event.found}} 本`;
+            }} else if (event.type === 'done') {{
+                status.textContent = `搜索完成 - 已找到 ${{event.found}} 本`;
+                source.close();
+            }}
+        }};
+    </script>
 </body>
 </html>
 '''
-    with open(html_path, 'w', encoding='utf-8') as f:
-        f.write(html_content)
-    return html_path
-
-def update_progress_html(current, total, repo_name, found_count):
-    """更新进度 HTML"""
-    html_path = '/tmp/book_search_progress.html'
-    progress = int((current / total) * 100)
-    
+
+class ProgressServer:
+    """本地进度页面服务器，通过 Server-Sent Events 实时推送搜索进度
+
+    只监听 127.0.0.1 的随机端口。新连接的页面会先收到已发生的全部事件。
+    """
+
+    def __init__(self, book_name):
+        self._page = PROGRESS_PAGE.format(book_name=html.escape(book_name)).encode('utf-8')
+        self._events = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/book_search_progress"
+
+    def publish(self, **event):
+        """推送一个进度事件"""
+        with self._cond:
+            self._events.append(json.dumps(event, ensure_ascii=False))
+            self._cond.notify_all()
+
+    def close(self):
+        """结束事件流并关闭服务器"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _stream(self, wfile):
+        sent = 0
+        while True:
+            with self._cond:
+                if sent == len(self._events) and not self._closed:
+                    self._cond.wait(timeout=15)
+                events = self._events[sent:]
+                closed = self._closed
+            if closed and not events:
+                return
+            sent += len(events)
+            # 没有新事件时发送注释行保持连接
+            payload = ''.join(f"data: {event}\n\n" for event in events) or ': keep-alive\n\n'
+            wfile.write(payload.encode('utf-8'))
+            wfile.flush()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/events':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+                    self.send_header('Cache-Control', 'no-cache')
+                    self.end_headers()
+                    try:
+                        server._stream(self.wfile)
+                    except OSError:
+                        pass
+                elif self.path == '/book_search_progress':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html; charset=utf-8')
+                    self.send_header('Content-Length', str(len(server._page)))
+                    self.end_headers()
+                    self.wfile.write(server._page)
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+REPO_STATS_PATH = os.path.join(CACHE_DIR, 'repo_stats.json')
+
+_repo_stats = None
+_repo_stats_lock = threading.Lock()
+
+def _load_repo_stats():
+    """读取各仓库的历史搜索统计"""
+    global _repo_stats
+    if _repo_stats is None:
+        try:
+            with open(REPO_STATS_PATH, 'r', encoding='utf-8') as f:
+                _repo_stats = json.load(f)
+        except (OSError, ValueError):
+            _repo_stats = {}
+    return _repo_stats
+
+def _save_repo_stats():
+    """保存仓库统计，调用方需持有 _repo_stats_lock"""
     try:
-        with open(html_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # 更新进度条
-        content = content.replace(
-            'style="width: 0%"', f'style="width: {progress}%"'
-        ).replace(
-            f'style="width: {progress-int(100/total)}%"', f'style="width: {progress}%"'
-        )
-        
-        # 更新状态文字
-        import re
-        content = re.sub(
-            r'<div class="status">.*?</div>',
-            f'<div class="status">进度: {current}/{total} ({progress}%) - 已找到 {found_count} 本</div>',
-            content
-        )
-        content = re.sub(
-            r'<div class="repo">.*?</div>',
-            f'<div class="repo">正在扫描: {repo_name}</div>',
-            content
-        )
-        
-        with open(html_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-    except:
+        os.makedirs(os.path.dirname(REPO_STATS_PATH), exist_ok=True)
+        tmp_path = _temp_path(REPO_STATS_PATH)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(_repo_stats, f, ensure_ascii=False)
+        os.replace(tmp_path, REPO_STATS_PATH)
+    except OSError:
         pass
 
+def _ewma(previous, value, weight=0.3):
+    """指数移动平均，没有旧值时直接取新值"""
+    return value if previous is None else (1 - weight) * previous + weight * value
+
+def query_language(query):
+    """搜索词的语言：包含中文时为 'zh'，否则为 'en'"""
+    return 'zh' if _CJK_RE.search(normalize_text(query)) else 'en'
+
+def record_repo_result(repo_name, hits, language=None, elapsed=None, started=None):
+    """记录一次仓库搜索的命中数、搜索词语言和网络耗时；成功搜索会清除失败记录
+
+    elapsed 只在这次搜索确实访问了网络时给出，命中缓存的搜索不计入耗时。
+    started 为搜索开始的时间：搜索开始后又记录了失败（如已被判定超时）时，
+    迟到的结果不清除连续失败次数。
+    """
+    with _repo_stats_lock:
+        stats = _load_repo_stats().setdefault(repo_name, {})
+        stats['searches'] = stats.get('searches', 0) + 1
+        stats['hits'] = stats.get('hits', 0) + (1 if hits else 0)
+        if language:
+            by_language = stats.setdefault('languages', {}).setdefault(language, {})
+            by_language['searches'] = by_language.get('searches', 0) + 1
+            by_language['hits'] = by_language.get('hits', 0) + (1 if hits else 0)
+        if elapsed is not None:
+            stats['latency'] = _ewma(stats.get('latency'), elapsed)
+        if started is None or started >= stats.get('failed_at', 0):
+            stats.pop('consecutive_failures', None)
+            stats.pop('missing', None)
+        _save_repo_stats()
+
+def record_repo_latency(repo_name, elapsed):
+    """记录一次访问仓库（检查或下载文件列表）的网络耗时"""
+    with _repo_stats_lock:
+        stats = _load_repo_stats().setdefault(repo_name, {})
+        stats['latency'] = _ewma(stats.get('latency'), elapsed)
+        _save_repo_stats()
+
+def record_repo_failure(repo_name, error):
+    """记录一次仓库搜索失败；仓库不存在（404）时标记为 missing"""
+    with _repo_stats_lock:
+        stats = _load_repo_stats().setdefault(repo_name, {})
+        stats['failures'] = stats.get('failures', 0) + 1
+        stats['consecutive_failures'] = stats.get('consecutive_failures', 0) + 1
+        stats['failed_at'] = time.time()
+        if isinstance(error, urllib.error.HTTPError) and error.code == 404:
+            stats['missing'] = True
+        _save_repo_stats()
+
+def record_download_result(repo_name, ok, elapsed=None, size=None):
+    """记录一次从该仓库下载的结果，成功时记录下载速度（指数移动平均）"""
+    with _repo_stats_lock:
+        stats = _load_repo_stats().setdefault(repo_name, {})
+        stats['downloads'] = stats.get('downloads', 0) + 1
+        if not ok:
+            stats['download_failures'] = stats.get('download_failures', 0) + 1
+        elif elapsed and size:
+            stats['download_speed'] = _ewma(stats.get('download_speed'), size / max(elapsed, 0.001))
+        _save_repo_stats()
+
+def rank_mirrors(mirrors):
+    """按下载失败率从低到高、速度从快到慢排列镜像，没有记录的仓库排在中间"""
+    with _repo_stats_lock:
+        stats = dict(_load_repo_stats())
+
+    def key(mirror):
+        repo_stats = stats.get(mirror['repository']['full_name'], {})
+        failure_rate = (repo_stats.get('download_failures', 0) + 1) / (repo_stats.get('downloads', 0) + 4)
+        return failure_rate, -repo_stats.get('download_speed', 0)
+
+    return sorted(mirrors, key=key)
+
+# 连续失败这么多次的仓库视为不可用，排到最后
+REPO_DEAD_AFTER = 3
+# 扫描耗时的参考值（秒）：平均耗时每多这么多，优先级降低一倍
+REPO_LATENCY_SCALE = 5.0
+
+def repo_priority(repo_stats, language=None):
+    """仓库的扫描优先级，越大越先扫描
+
+    以该语言搜索词的历史命中率为主（记录少时向总命中率收缩），
+    乘以搜索成功率，再按平均耗时降低；返回 (是否可用, 得分)，不可用的仓库排在最后。
+    """
+    # 拉普拉斯平滑，没有记录的仓库按 50% 计
+    hit_rate = (repo_stats.get('hits', 0) + 1) / (repo_stats.get('searches', 0) + 2)
+    by_language = repo_stats.get('languages', {}).get(language) if language else None
+    if by_language:
+        hit_rate = (by_language.get('hits', 0) + 2 * hit_rate) / (by_language.get('searches', 0) + 2)
+    searches = repo_stats.get('searches', 0)
+    success_rate = (searches + 1) / (searches + repo_stats.get('failures', 0) + 1)
+    latency = repo_stats.get('latency') or 0.0
+    score = hit_rate * success_rate / (1 + latency / REPO_LATENCY_SCALE)
+    alive = not repo_stats.get('missing') and repo_stats.get('consecutive_failures', 0) < REPO_DEAD_AFTER
+    return alive, score
+
+def prioritize_repos(repo_list, query=None):
+    """按历史命中率、成功率和耗时排列仓库，不存在或屡次失败的仓库排到最后
+
+    给出搜索词时按其语言（中文/英文）的命中率排序。
+    """
+    with _repo_stats_lock:
+        stats = dict(_load_repo_stats())
+    language = query_language(query) if query else None
+    return sorted(repo_list, key=lambda repo: repo_priority(stats.get(repo, {}), language),
+                  reverse=True)
+
+def _estimated_cost(repo_name):
+    """估计扫描一个仓库需要消耗的 API 配额"""
+    return get_source(repo_name).api_cost()
+
+def schedule_repos(repo_list, query=None):
+    """按历史表现排序，并按剩余配额挑出本次能完整扫描的仓库
+
+    返回 (本次扫描的仓库, 因配额不足推迟的仓库)。配额未知或窗口已重置时全部扫描。
+    """
+    ordered = prioritize_repos(repo_list, query)
+    status = _token_pool.status()
+    budget = status['remaining']
+    if budget is None or status['reset'] <= time.time():
+        return ordered, []
+    
+    scan_now = []
+    deferred = []
+    for repo in ordered:
+        cost = _estimated_cost(repo)
+        if cost <= budget:
+            budget -= cost
+            scan_now.append(repo)
+        else:
+            deferred.append(repo)
+    return scan_now, deferred
+
+def _timed_search(search_func, repo, book_name):
+    """执行搜索并计时，返回 (结果, 异常, 耗时秒数)"""
+    started = time.time()
+    try:
+        return search_func(repo, book_name), None, time.time() - started
+    except Exception as e:
+        return [], e, time.time() - started
+
+def _spawn_daemon(func, *args):
+    """在守护线程中执行 func(*args)，返回对应的 Future
+
+    提前结束或超时后不再等待的任务不会阻止进程退出（线程池的工作线程会在退出时被等待）。
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+def iter_scan(repo_list, book_name, search_func, max_workers=SCAN_WORKERS,
+              stop_event=None, on_start=None, timeout=None):
+    """并发扫描仓库，每完成一个仓库产出一个字典
+
+    字典包含 done（已完成数）、repo、results、error（异常或 None）和 elapsed（秒）。
+    开始扫描某个仓库时调用 on_start(仓库名)。
+    timeout(仓库名) 返回该仓库的超时秒数，超时的仓库以 TimeoutError 结束，不再等待其结果。
+    同时最多扫描 max_workers 个仓库，每个仓库在守护线程中扫描；调用方停止迭代
+    （或设置 stop_event）后不再开始新的仓库，正在进行的请求不再等待，也不会阻止进程退出。
+    """
+    stop_event = stop_event or threading.Event()
+    pending = {}
+    deadlines = {}
+    repos = iter(repo_list)
+
+    def submit_next():
+        for repo in repos:
+            future = _spawn_daemon(_timed_search, search_func, repo, book_name)
+            pending[future] = repo
+            if timeout:
+                deadlines[future] = time.time() + timeout(repo)
+            if on_start:
+                on_start(repo)
+            return True
+        return False
+
+    try:
+        # 只预先开始 max_workers 个任务，之后每完成一个再开始下一个
+        for _ in range(max(1, max_workers)):
+            if not submit_next():
+                break
+
+        done_count = 0
+        while pending and not stop_event.is_set():
+            done, _ = wait(list(pending), timeout=0.2, return_when=FIRST_COMPLETED)
+            now = time.time()
+            expired = [future for future in pending
+                       if future not in done and deadlines.get(future, now) < now]
+            for future in list(done) + expired:
+                repo = pending.pop(future)
+                deadlines.pop(future, None)
+                if future in done:
+                    results, error, elapsed = future.result()
+                else:
+                    # 超时的任务在后台自行结束，结果丢弃
+                    results, error, elapsed = [], TimeoutError(f"{repo} 超时"), timeout(repo)
+                    record_repo_failure(repo, error)
+                    record_repo_latency(repo, elapsed)
+                done_count += 1
+                submit_next()
+                yield {
+                    'done': done_count,
+                    'repo': repo,
+                    'results': results,
+                    'error': error,
+                    'elapsed': elapsed,
+                }
+                if stop_event.is_set():
+                    break
+    finally:
+        stop_event.set()
+
 def show_progress_window(title, book_name, repo_list, search_func):
     """显示搜索进度并执行搜索"""
     total = len(repo_list)
-    all_results = []
+    top = TopResults(MAX_RESULTS)
     
-    # 创建并打开进度页面
-    html_path = create_progress_html(book_name)
-    browser_proc = subprocess.Popen(
-        ['open', '-a', 'Safari', html_path],
+    # 启动本地进度服务器并在 Safari 中打开，页面通过事件流实时更新
+    progress = ProgressServer(book_name)
+    subprocess.Popen(
+        ['open', '-a', 'Safari', progress.url],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL
     )
     
-    import time
-    time.sleep(0.5)  # 等待浏览器打开
+    def on_start(repo):
+        progress.publish(type='scanning', repo=repo)
     
-    for i, repo in enumerate(repo_list):
-        # 更新进度
-        update_progress_html(i + 1, total, repo.split('/')[-1], len(all_results))
-        
-        # 执行搜索
-        results = search_func(repo, book_name)
-        all_results.extend(results)
-        
-        # 如果找到足够多结果，提前结束
-        if len(all_results) >= 20:
-            break
+    try:
+        for event in iter_scan(repo_list, book_name, search_func, on_start=on_start,
+                               timeout=source_timeout):
+            for result in event['results']:
+                top.push(result)
+            
+            # 更新进度
+            progress.publish(
+                type='repo',
+                repo=event['repo'],
+                done=event['done'],
+                total=total,
+                hits=len(event['results']),
+                found=len(top),
+                elapsed_ms=int(event['elapsed'] * 1000),
+                error=str(event['error']) if event['error'] else None,
+            )
+            
+            # 已有足够多完整匹配的结果时提前结束（未完成的请求随之取消）
+            if top.good_enough():
+                break
+        progress.publish(type='done', found=len(top))
+    finally:
+        progress.close()
     
     # 关闭进度页面
     subprocess.run(['osascript', '-e', '''
@@ -218,62 +1871,70 @@ def show_progress_window(title, book_name, repo_list, search_func):
         end tell
     '''], capture_output=True)
     
-    return all_results
+    return top.sorted()
 
 def search_github(book_name):
-    """在 GitHub 上搜索 epub 文件，显示 UI 进度"""
+    """在 GitHub 上搜索电子书文件，显示 UI 进度"""
     # 使用进度窗口搜索
+    repo_list, deferred = schedule_repos(source_names(), book_name)
     all_results = show_progress_window(
         f"搜索: {book_name}",
         book_name,
-        KNOWN_EBOOK_REPOS,
-        search_repo_for_epub
+        repo_list,
+        search_source
     )
     
-    # 如果找到了就返回
+    # 没有结果、又有仓库因配额不足推迟时，等待时间不长就等配额窗口重置后再搜索这些仓库
+    if not all_results and deferred and _token_pool.wait_for_reset():
+        all_results = show_progress_window(f"搜索: {book_name}", book_name, deferred, search_source)
+        deferred = []
+    
+    # 如果找到了就返回，有仓库未搜索时提示
     if all_results:
-        return all_results[:20]
+        if deferred:
+            show_progress_notification(
+                "部分仓库未搜索", f"{RateLimitError(_token_pool.reset)}，{len(deferred)} 个仓库未搜索")
+        return all_results[:MAX_RESULTS]
     
-    # 尝试使用 gh CLI 搜索
+    # 配额用完时明确告知，而不是显示“未找到”
+    if deferred or _token_pool.exhausted():
+        show_alert("搜索受限", str(RateLimitError(_token_pool.reset)), is_error=True)
+        return []
+    
+    # 尝试使用 gh CLI 搜索，代码搜索不支持 extension 的“或”，按偏好顺序逐个格式查询
+    items = []
     try:
         show_progress_notification("搜索中", "正在使用 GitHub API 搜索...")
-        query = f"{book_name} extension:epub"
-        result = subprocess.run(
-            ['gh', 'api', 'search/code', '-X', 'GET', 
-             '-f', f'q={query}', '-f', 'per_page=10'],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            items = data.get('items', [])
-            if items:
-                return items
+        for fmt in EBOOK_FORMATS:
+            query = f"{book_name} extension:{fmt.lstrip('.')}"
+            result = subprocess.run(
+                ['gh', 'api', 'search/code', '-X', 'GET', 
+                 '-f', f'q={query}', '-f', 'per_page=10'],
+                capture_output=True,
+                text=True,
+                timeout=30
+            )
+            if result.returncode != 0:
+                break
+            items.extend(json.loads(result.stdout).get('items', []))
+            if len(items) >= 10:
+                break
     except:
         pass
     
-    return []
+    return items[:10]
 
 def search_github_repos(book_name):
     """搜索包含关键词的仓库"""
     query = urllib.parse.quote(f"{book_name} epub")
-    url = f"https://api.github.com/search/repositories?q={query}&per_page=5"
-    
-    headers = {
-        "Accept": "application/vnd.github.v3+json",
-        "User-Agent": "BookDownloader/1.0"
-    }
-    
-    req = urllib.request.Request(url, headers=headers)
+    url = f"{GITHUB_API}/search/repositories?q={query}&per_page=5"
     
     try:
-        with urllib.request.urlopen(req, timeout=30) as response:
+        with open_url(url, timeout=30) as response:
             data = json.loads(response.read().decode('utf-8'))
             repos = data.get('items', [])
             
-            # 在找到的仓库中搜索 epub 文件
+            # 在找到的仓库中搜索电子书文件
             results = []
             for repo in repos[:3]:  # 只检查前3个仓库
                 epub_files = search_repo_for_epub(repo['full_name'], book_name)
@@ -286,135 +1947,1598 @@ def search_github_repos(book_name):
         show_alert("搜索失败", str(e), is_error=True)
         return []
 
-def search_repo_for_epub(repo_name, book_name):
-    """在指定仓库中搜索 epub 文件"""
-    url = f"https://api.github.com/repos/{repo_name}/git/trees/HEAD?recursive=1"
-    
-    headers = {
-        "Accept": "application/vnd.github.v3+json",
-        "User-Agent": "BookDownloader/1.0"
-    }
-    
-    req = urllib.request.Request(url, headers=headers)
-    
+def search_repo_for_epub(repo_name, book_name, formats=None):
+    """在指定仓库中搜索电子书文件
+
+    formats 为按偏好排列的格式列表（如 ['.pdf', '.epub']），只返回这些格式，
+    默认为 EBOOK_FORMATS。所有格式来自同一份缓存树，切换格式不需要重新扫描。
+    """
+    started = time.time()
     try:
-        with urllib.request.urlopen(req, timeout=15) as response:
-            data = json.loads(response.read().decode('utf-8'))
-            tree = data.get('tree', [])
-            
-            results = []
-            # 分割搜索词以支持多关键词搜索
-            keywords = [k.strip() for k in book_name.replace('，', ' ').replace(',', ' ').split() if k.strip()]
-            
-            for item in tree:
-                path = item.get('path', '')
-                if path.endswith('.epub'):
-                    filename = os.path.basename(path)
-                    # 检查文件名是否包含任一关键词（中文直接比较，英文忽略大小写）
-                    path_lower = path.lower()
-                    filename_lower = filename.lower()
-                    
-                    for keyword in keywords:
-                        kw_lower = keyword.lower()
-                        if keyword in path or keyword in filename or kw_lower in path_lower or kw_lower in filename_lower:
-                            results.append({
-                                'name': filename,
-                                'path': path,
-                                'repository': {'full_name': repo_name}
-                            })
-                            break
-            
-            return results
+        index = get_repo_index(repo_name)
+    except RateLimitError:
+        raise
     except Exception as e:
+        record_repo_failure(repo_name, e)
         return []
+    
+    # 分割搜索词以支持多关键词搜索，命中任一关键词即可；精确查找无结果时容错查找
+    keywords = split_keywords(book_name)
+    doc_ids = set()
+    for keyword in keywords:
+        doc_ids |= search_index(index, keyword) or fuzzy_search_index(index, keyword)
+    
+    results = index_results(index, doc_ids, keywords, formats)
+    record_repo_result(repo_name, len(results), query_language(book_name), started=started)
+    return results
+
+def format_bonus(fmt, formats):
+    """格式偏好加分：最偏好的格式加满分，其余按顺序递减；不在 formats 中时返回 None"""
+    if fmt not in formats:
+        return None
+    return FORMAT_BONUS * (len(formats) - formats.index(fmt)) / len(formats)
+
+def index_results(index, doc_ids, keywords, formats=None):
+    """把索引中命中的文档转换为按得分排序的结果字典，只保留 formats 中的格式"""
+    formats = normalize_formats(formats) if formats else EBOOK_FORMATS
+    repo_name = index['repo']
+    results = []
+    for doc_id in doc_ids:
+        path = index['tree'][doc_id]['path']
+        fmt = os.path.splitext(path)[1].lower()
+        bonus = format_bonus(fmt, formats)
+        if bonus is None:
+            continue
+        score = score_path(path, keywords)
+        if score <= 0:
+            # 关键词没有出现在路径中（索引候选只是部分命中），不能只凭格式加分返回
+            continue
+        entry = index['tree'][doc_id]
+        results.append({
+            'name': os.path.basename(path),
+            'path': path,
+            'repository': {'full_name': repo_name},
+            'sha': entry.get('sha'),
+            'size': entry.get('size'),
+            # 索引所在的提交，下载时从该提交取文件，与 sha 和大小一致
+            'commit': index.get('commit'),
+            'format': fmt,
+            'score': score + bonus,
+        })
+    results.sort(key=lambda result: result['score'], reverse=True)
+    return results
+
+# 边输入边搜索时，短于此长度的英文输入不搜索（一两个字母几乎匹配所有文件）
+INCREMENTAL_MIN_LENGTH = 2
+# 边输入边搜索记住的查询数上限，超过后清空重来
+INCREMENTAL_MEMO_SIZE = 512
+
+class IncrementalSearch:
+    """边输入边搜索：只使用本地已缓存的索引，每次输入变化时调用 update(查询)
+
+    每个关键词命中的文档集合都会记住。在关键词末尾继续输入时，新结果一定是
+    旧结果的子集，只需在旧结果中过滤；英文前缀也只在上一次的词表区间内继续缩小。
+    删除字符回到之前的输入时直接返回记住的结果。
+    输入过程中最后一个词往往不完整，因此不做容错匹配。
+    """
+
+    def __init__(self, repo_list=None, limit=MAX_RESULTS, formats=None):
+        if repo_list is None:
+            repo_list = source_names(indexed_only=True)
+        self.limit = limit
+        self.formats = formats
+        self.indexes = [index for index in map(local_index, repo_list) if index is not None]
+        self._keyword_docs = {}
+        self._prefix_ranges = {}
+        self._results = {}
+
+    def _prefix_docs(self, i, index, term):
+        """英文前缀命中的文档，从已记住的最长前缀的词表区间开始查找"""
+        vocab = index['terms']
+        lo, hi = 0, len(vocab)
+        for end in range(len(term) - 1, 0, -1):
+            if (i, term[:end]) in self._prefix_ranges:
+                lo, hi = self._prefix_ranges[(i, term[:end])]
+                break
+        lo = bisect.bisect_left(vocab, term, lo, hi)
+        ids = set()
+        pos = lo
+        while pos < hi and vocab[pos].startswith(term):
+            ids.update(index['postings'][vocab[pos]])
+            pos += 1
+        self._prefix_ranges[(i, term)] = (lo, pos)
+        return ids
+
+    def _search_keyword(self, keyword):
+        """关键词在各仓库中命中的文档集合列表，与 search_index 的结果相同"""
+        key = normalize_text(keyword)
+        if key in self._keyword_docs:
+            return self._keyword_docs[key]
+        base = None
+        for end in range(len(key) - 1, 0, -1):
+            base = self._keyword_docs.get(key[:end])
+            if base is not None:
+                break
+
+        terms = query_terms(keyword)
+        doc_sets = []
+        for i, index in enumerate(self.indexes):
+            candidates = None if base is None else base[i]
+            for term, is_prefix in terms:
+                if candidates is not None and not candidates:
+                    break
+                if is_prefix:
+                    ids = self._prefix_docs(i, index, term)
+                else:
+                    ids = index['postings'].get(term, ())
+                candidates = set(ids) if candidates is None else candidates.intersection(ids)
+            if candidates is None:
+                candidates = range(len(index['texts']))
+            texts = index['texts']
+            doc_sets.append({doc_id for doc_id in candidates if key in texts[doc_id]})
+        self._keyword_docs[key] = doc_sets
+        return doc_sets
+
+    def update(self, query):
+        """返回当前输入对应的结果列表，按得分从高到低"""
+        keywords = split_keywords(query)
+        key = tuple(normalize_text(keyword) for keyword in keywords)
+        if key in self._results:
+            return self._results[key]
+        text = ''.join(key)
+        if not keywords or (len(text) < INCREMENTAL_MIN_LENGTH and not _CJK_RE.search(text)):
+            return []
+        if len(self._results) > INCREMENTAL_MEMO_SIZE:
+            self._results.clear()
+            self._keyword_docs.clear()
+            self._prefix_ranges.clear()
+
+        doc_sets = [self._search_keyword(keyword) for keyword in keywords]
+        top = TopResults(self.limit)
+        for i, index in enumerate(self.indexes):
+            doc_ids = set().union(*(docs[i] for docs in doc_sets))
+            for result in index_results(index, doc_ids, keywords, self.formats):
+                top.push(result)
+        results = self._results[key] = top.sorted()
+        return results
+
+# 下载时每次读写的字节数
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# 下载连接的超时时间（秒）
+DOWNLOAD_TIMEOUT = 120
+# 连接中断后的续传次数
+DOWNLOAD_RETRIES = 3
+
+class IntegrityError(IOError):
+    """下载的内容与仓库记录的 sha 或大小不一致"""
+
+# Git LFS 指针文件小于此大小；文件树中记录的是指针的 sha 和大小，raw 地址返回的却是实际内容
+LFS_POINTER_MAX_SIZE = 1024
+
+def is_lfs_pointer(size, actual_size):
+    """文件树中的大小是否像 Git LFS 指针（记录很小而实际内容更大），这种文件无法按 sha 校验"""
+    return (size is not None and actual_size is not None
+            and size < LFS_POINTER_MAX_SIZE and actual_size > size)
+
+def git_blob_sha(filepath, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """按 Git 的方式计算文件的 blob SHA-1，与仓库文件树中的 sha 可直接比较"""
+    digest = _blob_digest(os.path.getsize(filepath))
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _blob_digest(size):
+    """Git blob SHA-1 的初始状态，之后按顺序 update 文件内容即可"""
+    return hashlib.sha1(b'blob %d\0' % size)
+
+def _is_retryable(error):
+    """网络错误或服务器 5xx 错误可以重试，内容校验失败和其余 HTTP 错误直接失败"""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    if isinstance(error, IntegrityError):
+        return False
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def _content_total(response, offset):
+    """从响应头得到文件总大小，未知时返回 None"""
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    length = response.headers.get('Content-Length')
+    return offset + int(length) if length else None
+
+def _hash_prefix(path, length, digest, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """把文件开头 length 字节加入 digest，用于续传时补上已下载部分"""
+    if not length:
+        return
+    with open(path, 'rb') as f:
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            digest.update(chunk)
+            length -= len(chunk)
+
+def stream_download(url, filepath, progress=None, retries=DOWNLOAD_RETRIES,
+                    chunk_size=DOWNLOAD_CHUNK_SIZE, sha=None, size=None):
+    """分块下载到 filepath.part，中断后用 Range 请求续传，完成后原子改名
+
+    progress(已下载字节数, 总字节数或 None) 在每块写入后调用。
+    给出 sha 时边写边计算 Git blob SHA-1，完成后与 sha、size（未知时用服务器给出的大小）比较，
+    不一致时删除文件并抛出 IntegrityError；续传得到的文件不一致时先从头重新下载一次。
+    Git LFS 文件（见 is_lfs_pointer）不做校验。
+    """
+    part_path = filepath + '.part'
+    attempt = 0
+    digest = None
+    hashed = 0
+    resumed = False
+    while True:
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with open_url(url, headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                if offset and response.status != 206:
+                    # 服务器不支持续传，从头开始
+                    offset = 0
+                total = _content_total(response, offset)
+                if is_lfs_pointer(size, total):
+                    sha = size = digest = None
+                if size is not None and total is not None and total != size:
+                    # 大小对不上（多半是错误页面），不必下载完再校验
+                    raise IntegrityError(
+                        f"{os.path.basename(filepath)} 大小为 {total} 字节，应为 {size} 字节")
+                if sha and size is None:
+                    # 文件树中没有记录大小（来自增量更新）时，以服务器给出的大小为准
+                    size = total
+                if sha and size is not None and (digest is None or hashed != offset):
+                    # 首次下载，或续传位置与已计算的部分不一致，补算已下载的部分
+                    digest = _blob_digest(size)
+                    _hash_prefix(part_path, offset, digest)
+                    resumed = resumed or offset > 0
+                hashed = offset
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        if digest:
+                            digest.update(chunk)
+                        offset += len(chunk)
+                        hashed = offset
+                        if progress:
+                            progress(offset, total)
+                if total is not None and offset < total:
+                    raise http.client.IncompleteRead(b'', total - offset)
+        except Exception as e:
+            # 416 表示请求范围超出文件末尾，说明上次已经下载完整
+            if not (isinstance(e, urllib.error.HTTPError) and e.code == 416 and offset):
+                attempt += 1
+                if attempt > retries or not _is_retryable(e):
+                    raise
+                time.sleep(min(2 ** attempt, 10))
+                continue
+        if sha and not is_lfs_pointer(size, offset):
+            if digest is None or hashed != offset:
+                digest = _blob_digest(offset if size is None else size)
+                _hash_prefix(part_path, offset, digest)
+                hashed = offset
+            if (size is not None and hashed != size) or digest.hexdigest() != sha:
+                os.remove(part_path)
+                if resumed:
+                    # 可能把不同版本的文件拼在了一起，从头再下载一次
+                    resumed = False
+                    digest = None
+                    continue
+                raise IntegrityError(f"{os.path.basename(filepath)} 内容校验失败")
+        break
+    os.replace(part_path, filepath)
+
+# 文件达到此大小且服务器支持 Range 时分段并发下载
+SEGMENT_THRESHOLD = 8 * 1024 * 1024
+# 分段下载使用的连接数
+DOWNLOAD_CONNECTIONS = int(os.environ.get('BOOK_DOWNLOADER_CONNECTIONS', '4'))
+
+def probe_download(url):
+    """探测下载地址，返回 (重定向后的 URL, 文件大小或 None, 是否支持 Range)"""
+    with open_url(url, {'Range': 'bytes=0-0'}, timeout=30) as response:
+        final_url = response.geturl()
+        if response.status == 206:
+            return final_url, _content_total(response, 0), True
+        return final_url, _content_total(response, 0), False
+
+def segmented_download(url, filepath, total, connections=DOWNLOAD_CONNECTIONS,
+                       progress=None, retries=DOWNLOAD_RETRIES,
+                       chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """把文件按字节范围分段，用多个连接并发下载并写入预分配文件的对应位置"""
+    # 与 stream_download 的 .part 区分，避免把预分配的文件误当成已下载的部分续传
+    part_path = filepath + '.segments.part'
+    with open(part_path, 'wb') as f:
+        f.truncate(total)
+
+    segment_size = -(-total // connections)
+    segments = [(start, min(start + segment_size, total) - 1)
+                for start in range(0, total, segment_size)]
+    lock = threading.Lock()
+    downloaded = [0]
+
+    def fetch_segment(start, end):
+        pos = start
+        attempt = 0
+        while pos <= end:
+            try:
+                with open_url(url, {'Range': f'bytes={pos}-{end}'},
+                              timeout=DOWNLOAD_TIMEOUT) as response:
+                    if response.status != 206:
+                        raise IOError("服务器不支持分段下载")
+                    with open(part_path, 'r+b') as f:
+                        f.seek(pos)
+                        while pos <= end:
+                            chunk = response.read(min(chunk_size, end - pos + 1))
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            pos += len(chunk)
+                            with lock:
+                                downloaded[0] += len(chunk)
+                                if progress:
+                                    progress(downloaded[0], total)
+                if pos <= end:
+                    raise http.client.IncompleteRead(b'', end - pos + 1)
+            except Exception as e:
+                attempt += 1
+                if attempt > retries or not _is_retryable(e):
+                    raise
+                time.sleep(min(2 ** attempt, 10))
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(fetch_segment, start, end) for start, end in segments]
+            for future in futures:
+                future.result()
+    except Exception:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+    os.replace(part_path, filepath)
+
+def fetch_to_file(url, filepath, progress=None, connections=DOWNLOAD_CONNECTIONS,
+                  sha=None, size=None):
+    """下载到指定路径：大文件且服务器支持 Range 时分段并发，否则单连接流式下载
 
-def download_file(url, filepath):
+    给出 sha 时校验内容（size 为 None 时只校验 sha），不一致时抛出 IntegrityError。
+    Git LFS 文件（见 is_lfs_pointer）不做校验。
+    """
+    if connections > 1:
+        try:
+            final_url, total, ranged = probe_download(url)
+        except Exception:
+            ranged = False
+        if ranged and total and total >= SEGMENT_THRESHOLD:
+            if is_lfs_pointer(size, total):
+                sha = size = None
+            if size is not None and total != size:
+                raise IntegrityError(
+                    f"{os.path.basename(filepath)} 大小为 {total} 字节，应为 {size} 字节")
+            segmented_download(final_url, filepath, total, connections, progress)
+            if sha:
+                # 各段乱序到达，无法边下边算，只能在完成后读回（此时多半仍在页缓存中）
+                verify_file(filepath, sha, size)
+            return
+    stream_download(url, filepath, progress, sha=sha, size=size)
+
+# 已下载电子书的本地书库，按 Git blob SHA 存放，同一本书只下载一次
+LIBRARY_DIR = os.path.expanduser(os.environ.get('BOOK_DOWNLOADER_LIBRARY',
+                                                os.path.join(CACHE_DIR, 'library')))
+# 书库总大小上限（字节），超出后按最近最少使用淘汰
+LIBRARY_MAX_BYTES = int(os.environ.get('BOOK_DOWNLOADER_LIBRARY_MAX_BYTES', 2 * 1024 ** 3))
+
+def verify_file(filepath, sha, size=None):
+    """校验下载的文件，不一致时删除文件并抛出 IntegrityError"""
+    actual_size = os.path.getsize(filepath)
+    if size is not None and actual_size != size:
+        problem = f"大小为 {actual_size} 字节，应为 {size} 字节"
+    elif git_blob_sha(filepath) != sha:
+        problem = "内容校验失败"
+    else:
+        return
+    os.remove(filepath)
+    raise IntegrityError(f"{os.path.basename(filepath)} {problem}")
+
+def library_path(sha):
+    """书库中某个 blob 的存放路径"""
+    return os.path.join(LIBRARY_DIR, sha[:2], sha)
+
+def _clone_or_copy(src, dest):
+    """把文件复制到 dest，dest 原子替换；macOS 的 APFS 上用写时复制克隆，不额外占用空间
+
+    从不使用硬链接：修改保存的文件不能影响来源（书库或用户的本地目录）。
+    """
+    tmp_path = _temp_path(dest)
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    cloned = False
+    if sys.platform == 'darwin':
+        # cp -c 使用 clonefile，不支持克隆（如跨卷）时失败，改为普通复制
+        cloned = subprocess.run(['cp', '-c', src, tmp_path], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL).returncode == 0
+    if not cloned:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+def library_fetch(sha, filepath, size=None):
+    """书库中已有该 blob 时直接复制到 filepath 并返回 True，不产生任何网络请求
+
+    使用前重新校验 sha，书库文件被改动过时丢弃，返回 False 重新下载。
+    """
+    path = library_path(sha)
+    if not os.path.exists(path):
+        return False
+    try:
+        verify_file(path, sha, size)
+        # 更新访问时间，用于 LRU 淘汰
+        os.utime(path, None)
+        _clone_or_copy(path, filepath)
+        return True
+    except OSError:
+        return False
+
+def library_add(filepath, sha):
+    """把校验通过的文件加入书库；书库不可写时忽略"""
+    path = library_path(sha)
+    if os.path.exists(path):
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _clone_or_copy(filepath, path)
+    except OSError:
+        return
+    _evict_lru(LIBRARY_DIR, LIBRARY_MAX_BYTES, keep=path)
+
+def result_mirrors(result):
+    """搜索结果的全部下载来源，默认来源在前"""
+    return result.get('mirrors') or [_mirror(result)]
+
+def fetch_result(result, filepath, progress=None, connections=DOWNLOAD_CONNECTIONS, host_slot=None):
+    """下载一个搜索结果，当前镜像失败时依次换下一个镜像，返回成功的镜像
+
+    结果带 sha 时先查本地书库，已有的书直接复制到 filepath；下载时边写边校验 sha
+    和大小，不一致按失败处理并换下一个镜像，校验通过的文件加入书库。
+    同一结果的镜像内容完全相同（sha 一致），换镜像后可以接着已下载的部分续传。
+    连接中断只在 stream_download 中续传重试，这里不再整体重试。
+    host_slot(下载地址) 返回限制该主机并发数的信号量，每个镜像下载时分别获取。
+    """
+    sha = result.get('sha')
+    size = result.get('size')
+    if sha and library_fetch(sha, filepath, size):
+        return result_mirrors(result)[0]
+
+    error = None
+    for mirror in result_mirrors(result):
+        repo_name = mirror['repository']['full_name']
+        source = get_source(repo_name)
+        slot = host_slot(source.file_url(mirror['path'], mirror.get('commit'))) if host_slot else None
+        started = time.monotonic()
+        try:
+            if slot:
+                slot.acquire()
+            try:
+                source.fetch(mirror['path'], filepath, progress, connections, sha, size,
+                             mirror.get('commit'))
+            finally:
+                if slot:
+                    slot.release()
+        except Exception as e:
+            record_download_result(repo_name, False)
+            error = e
+            continue
+        actual_size = os.path.getsize(filepath)
+        record_download_result(repo_name, True, time.monotonic() - started, actual_size)
+        if sha and not is_lfs_pointer(size, actual_size):
+            # LFS 文件的 sha 是指针的 sha，不能按它存入书库
+            library_add(filepath, sha)
+        return mirror
+    raise error
+
+def download_file(result, filepath):
     """下载文件"""
-    headers = {"User-Agent": "BookDownloader/1.0"}
-    req = urllib.request.Request(url, headers=headers)
-    
     try:
         show_progress_notification("下载中", f"正在下载: {os.path.basename(filepath)}")
-        
-        with urllib.request.urlopen(req, timeout=120) as response:
-            data = response.read()
-            
-            with open(filepath, 'wb') as f:
-                f.write(data)
-        
+        fetch_result(result, filepath)
         return True
     except Exception as e:
         show_alert("下载失败", str(e), is_error=True)
         return False
 
+def raw_url(repo_name, path, commit='HEAD'):
+    """仓库文件在某个提交中的下载地址"""
+    return f"https://github.com/{repo_name}/raw/{commit}/{urllib.parse.quote(path)}"
+
+# 单个搜索源的默认超时（秒），超时后本次搜索不再等待它
+SOURCE_TIMEOUT = float(os.environ.get('BOOK_DOWNLOADER_SOURCE_TIMEOUT', '90'))
+
+class Source:
+    """搜索源：列出电子书（list）、搜索（search）和下载（fetch）
+
+    name 是源的唯一名称，用作缓存、索引和统计的键，也是结果中的 repository.full_name。
+    默认的 search 在 fetch_record 得到的文件列表上建立本地索引搜索，
+    子类通常只需实现 fetch_record 和 file_url。
+    """
+
+    # 是否有可建立本地索引的文件列表
+    indexed = True
+
+    def __init__(self, name, timeout=SOURCE_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+
+    def fetch_record(self, max_age=TREE_CACHE_TTL):
+        """返回文件列表记录 {repo, commit, checked_at, formats, tree}，tree 为 path、sha、size 条目"""
+        raise NotImplementedError
+
+    def api_cost(self):
+        """扫描一次估计消耗的 GitHub API 配额"""
+        return 0
+
+    def list(self):
+        """源中的全部电子书条目"""
+        return self.fetch_record()['tree']
+
+    def search(self, query, formats=None):
+        """搜索电子书，返回按得分排序的结果列表"""
+        return search_repo_for_epub(self.name, query, formats)
+
+    def load_index(self, max_age=TREE_CACHE_TTL):
+        """获取本地索引，文件列表过期时先更新"""
+        return tree_index(self.name, max_age)
+
+    def local_index(self):
+        """已有的本地索引，不访问网络；没有时返回 None"""
+        return cached_tree_index(self.name)
+
+    def rescan(self):
+        """立即重新检查文件列表并更新索引"""
+        return self.load_index(max_age=0)
+
+    def file_url(self, path, commit=None):
+        """文件在 commit（搜索结果所用索引的提交，未知时为 HEAD）中的下载地址"""
+        raise NotImplementedError
+
+    def fetch(self, path, filepath, progress=None, connections=DOWNLOAD_CONNECTIONS,
+              sha=None, size=None, commit=None):
+        """把文件下载到 filepath，给出 sha 时校验内容"""
+        fetch_to_file(self.file_url(path, commit), filepath, progress, connections, sha, size)
+
+class GitHubSource(Source):
+    """GitHub 仓库，名称即 owner/name"""
+
+    def fetch_record(self, max_age=TREE_CACHE_TTL):
+        return fetch_repo_tree(self.name, max_age)
+
+    def api_cost(self):
+        with _index_lock:
+            index = _repo_indexes.get(self.name)
+        if index and time.time() - index.get('checked_at', 0) < TREE_CACHE_TTL:
+            return 0
+        # 有缓存时只需检查 HEAD（304 不计配额）；没有缓存需要 HEAD 和整棵树
+        return 1 if os.path.exists(_tree_cache_path(self.name)) else 2
+
+    def file_url(self, path, commit=None):
+        # 用搜索结果所在的提交，保证下载的文件与结果中的 sha 和大小一致
+        return raw_url(self.name, path, commit or 'HEAD')
+
+class GitHostSource(Source):
+    """提供提交和文件树接口的其他代码托管服务（Gitee、GitLab 等）
+
+    子类实现 head_commit、list_tree 和 file_url；令牌以查询参数传递，
+    这样下载链接也能直接访问私有仓库。
+    """
+
+    DEFAULT_URL = None
+
+    def __init__(self, name, repo, url=None, token=None, timeout=SOURCE_TIMEOUT):
+        super().__init__(name, timeout)
+        self.repo = repo
+        self.url = (url or self.DEFAULT_URL).rstrip('/')
+        self.token = token
+
+    def _with_token(self, url, param):
+        if not self.token:
+            return url
+        separator = '&' if '?' in url else '?'
+        return f"{url}{separator}{param}={urllib.parse.quote(self.token)}"
+
+    def _get_json(self, url):
+        with open_url(url, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8')), response.headers
+
+    def head_commit(self):
+        """默认分支最新提交的 SHA"""
+        raise NotImplementedError
+
+    def list_tree(self, commit):
+        """该提交中的全部电子书条目"""
+        raise NotImplementedError
+
+    def fetch_record(self, max_age=TREE_CACHE_TTL):
+        cached = load_cached_tree(self.name)
+        now = time.time()
+        if cached and now - cached.get('checked_at', 0) < max_age:
+            return cached
+        commit = self.head_commit()
+        if cached and cached.get('commit') == commit:
+            cached['checked_at'] = now
+            save_cached_tree(cached)
+            return cached
+        record = {
+            'repo': self.name,
+            'commit': commit,
+            'etag': None,
+            'checked_at': now,
+            'formats': EBOOK_FORMATS,
+            'tree': self.list_tree(commit),
+        }
+        save_cached_tree(record)
+        return record
+
+class GiteeSource(GitHostSource):
+    """Gitee 仓库（API v5，树接口与 GitHub 相同）"""
+
+    DEFAULT_URL = 'https://gitee.com'
+
+    def _api(self, endpoint):
+        return self._with_token(f"{self.url}/api/v5/repos/{self.repo}/{endpoint}", 'access_token')
+
+    def head_commit(self):
+        commits, _ = self._get_json(self._api('commits?per_page=1'))
+        return commits[0]['sha']
+
+    def list_tree(self, commit):
+        with open_url(self._api(f'git/trees/{commit}?recursive=1'), timeout=self.timeout) as response:
+            return [_compact_entry(item) for item in iter_tree_entries(response, is_ebook_entry)]
+
+    def file_url(self, path, commit=None):
+        return self._with_token(
+            f"{self.url}/{self.repo}/raw/{commit or 'HEAD'}/{urllib.parse.quote(path)}", 'access_token')
+
+class GitLabSource(GitHostSource):
+    """GitLab 项目（API v4），repo 为 group/project；文件树接口不含大小"""
+
+    DEFAULT_URL = 'https://gitlab.com'
+
+    def _api(self, endpoint):
+        project = urllib.parse.quote(self.repo, safe='')
+        return self._with_token(f"{self.url}/api/v4/projects/{project}/{endpoint}", 'private_token')
+
+    def head_commit(self):
+        commits, _ = self._get_json(self._api('repository/commits?per_page=1'))
+        return commits[0]['id']
+
+    def list_tree(self, commit):
+        entries = []
+        page = '1'
+        while page:
+            items, headers = self._get_json(self._api(
+                f'repository/tree?recursive=true&per_page=100&ref={commit}&page={page}'))
+            entries.extend({'path': item['path'], 'sha': item.get('id'), 'size': None}
+                           for item in items
+                           if item.get('type') == 'blob' and ebook_format(item['path']))
+            page = headers.get('X-Next-Page')
+        return entries
+
+    def file_url(self, path, commit=None):
+        return self._api(f"repository/files/{urllib.parse.quote(path, safe='')}/raw?ref={commit or 'HEAD'}")
+
+class LocalSource(Source):
+    """本地目录（如挂载的 NAS），path 为相对该目录的路径；缓存过期后重新遍历目录"""
+
+    def __init__(self, name, root, timeout=SOURCE_TIMEOUT):
+        super().__init__(name, timeout)
+        self.root = root
+
+    def _walk(self):
+        """遍历目录，返回电子书条目，跳过隐藏目录和 PRUNED_DIRS"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith('.') and d.lower() not in PRUNED_DIRS]
+            for filename in filenames:
+                if not ebook_format(filename):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                try:
+                    size = os.path.getsize(full_path)
+                except OSError:
+                    continue
+                path = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                entries.append({'path': path, 'sha': None, 'size': size})
+        entries.sort(key=lambda item: item['path'])
+        return entries
+
+    def fetch_record(self, max_age=TREE_CACHE_TTL):
+        cached = load_cached_tree(self.name)
+        now = time.time()
+        if cached and now - cached.get('checked_at', 0) < max_age:
+            return cached
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(self.root)
+        tree = self._walk()
+        # 以路径和大小的摘要作为“提交”，目录内容不变时不重建索引
+        digest = hashlib.sha1()
+        for item in tree:
+            digest.update(f"{item['path']}\0{item['size']}\n".encode('utf-8'))
+        record = {
+            'repo': self.name,
+            'commit': digest.hexdigest(),
+            'etag': None,
+            'checked_at': now,
+            'formats': EBOOK_FORMATS,
+            'tree': tree,
+        }
+        save_cached_tree(record)
+        return record
+
+    def file_url(self, path, commit=None):
+        return 'file://' + urllib.request.pathname2url(os.path.join(self.root, path))
+
+    def fetch(self, path, filepath, progress=None, connections=DOWNLOAD_CONNECTIONS,
+              sha=None, size=None, commit=None):
+        _clone_or_copy(os.path.join(self.root, *path.split('/')), filepath)
+        if sha:
+            verify_file(filepath, sha, size)
+        if progress:
+            total = os.path.getsize(filepath)
+            progress(total, total)
+
+# 内存映射索引文件的格式版本
+MAPPED_INDEX_VERSION = 3
+_MAPPED_MAGIC = b'BDNX'
+
+def write_mapped_index(path, source_name, entries):
+    """把 (路径, 大小) 条目写成可内存映射的索引文件
+
+    文件开头是魔数和 JSON 头，之后是按 8 字节对齐的若干段：按路径排序的路径串与偏移量、
+    文件大小、有序索引词串与偏移量、每个词的倒排表偏移量和文档编号，
+    以及完整单词（供容错查找）在词表中的编号。
+    返回目录内容摘要（作为索引的“提交”）。
+    """
+    entries = sorted(entries, key=lambda item: item['path'])
+    digest = hashlib.sha1()
+    postings = {}
+    words = set()
+    for doc_id, item in enumerate(entries):
+        digest.update(f"{item['path']}\0{item['size']}\n".encode('utf-8'))
+        for term in index_terms(item['path'], words):
+            ids = postings.get(term)
+            if ids is None:
+                ids = postings[term] = array.array('I')
+            ids.append(doc_id)
+    terms = sorted(postings)
+
+    def strings(values):
+        encoded = [value.encode('utf-8') for value in values]
+        offsets = array.array('Q', [0])
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        return offsets, b''.join(encoded)
+
+    path_offsets, paths = strings(item['path'] for item in entries)
+    term_offsets, term_bytes = strings(terms)
+    posting_offsets = array.array('Q', [0])
+    posting_ids = array.array('I')
+    for term in terms:
+        posting_ids.extend(postings[term])
+        posting_offsets.append(len(posting_ids))
+    sections = [
+        ('path_offsets', path_offsets.tobytes()),
+        ('paths', paths),
+        ('sizes', array.array('Q', (item['size'] for item in entries)).tobytes()),
+        ('term_offsets', term_offsets.tobytes()),
+        ('terms', term_bytes),
+        ('posting_offsets', posting_offsets.tobytes()),
+        ('postings', posting_ids.tobytes()),
+        ('words', array.array('I', (i for i, term in enumerate(terms) if term in words)).tobytes()),
+    ]
+
+    layout = {}
+    offset = 0
+    for name, data in sections:
+        layout[name] = [offset, len(data)]
+        offset += -(-len(data) // 8) * 8
+    header = json.dumps({
+        'version': MAPPED_INDEX_VERSION,
+        'normalizer': NORMALIZER_ID,
+        'byteorder': sys.byteorder,
+        'repo': source_name,
+        'commit': digest.hexdigest(),
+        'formats': EBOOK_FORMATS,
+        'built_at': time.time(),
+        'sections': layout,
+    }).encode('utf-8')
+    header += b' ' * (-(len(header) + 8) % 8)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = _temp_path(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAPPED_MAGIC + len(header).to_bytes(4, 'little') + header)
+        for _, data in sections:
+            f.write(data)
+            f.write(b'\0' * (-len(data) % 8))
+    os.replace(tmp_path, path)
+    return digest.hexdigest()
+
+class _MappedStrings(collections.abc.Sequence):
+    """映射文件中按偏移量连续存放的 UTF-8 字符串，按需解码"""
+
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return str(self._data[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+class _MappedTree(collections.abc.Sequence):
+    """以树条目字典的形式访问映射索引中的文件"""
+
+    def __init__(self, paths, sizes):
+        self._paths = paths
+        self._sizes = sizes
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, i):
+        return {'path': self._paths[i], 'sha': None, 'size': self._sizes[i]}
+
+class _MappedTexts(collections.abc.Sequence):
+    """文档的搜索文本，需要时由路径计算（search_text 带缓存），不占用索引文件空间"""
+
+    def __init__(self, paths):
+        self._paths = paths
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, i):
+        return search_text(self._paths[i])
+
+class _MappedWords(collections.abc.Sequence):
+    """完整单词列表，按编号引用映射词表中的词"""
+
+    def __init__(self, terms, ids):
+        self._terms = terms
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        return self._terms[self._ids[i]]
+
+class _MappedPostings(collections.abc.Mapping):
+    """索引词到文档编号的映射，在有序词表上二分查找，编号直接来自映射内存"""
+
+    def __init__(self, terms, offsets, ids):
+        self._terms = terms
+        self._offsets = offsets
+        self._ids = ids
+
+    def __getitem__(self, term):
+        i = bisect.bisect_left(self._terms, term)
+        if i == len(self._terms) or self._terms[i] != term:
+            raise KeyError(term)
+        return self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self._terms)
+
+    def __len__(self):
+        return len(self._terms)
+
+def open_mapped_index(path, source_name):
+    """映射索引文件，返回与 JSON 索引接口相同的索引字典；文件不存在或版本不符时返回 None"""
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if data[:4] != _MAPPED_MAGIC:
+            return None
+        header_size = int.from_bytes(data[4:8], 'little')
+        header = json.loads(data[8:8 + header_size].decode('utf-8'))
+    except ValueError:
+        return None
+    if (header.get('version') != MAPPED_INDEX_VERSION or header.get('normalizer') != NORMALIZER_ID
+            or header.get('byteorder') != sys.byteorder or header.get('repo') != source_name
+            or header.get('formats') != EBOOK_FORMATS):
+        return None
+    view = memoryview(data)
+    start = 8 + header_size
+
+    def section(name, typecode=None):
+        offset, length = header['sections'][name]
+        part = view[start + offset:start + offset + length]
+        return part.cast(typecode) if typecode else part
+
+    paths = _MappedStrings(section('paths'), section('path_offsets', 'Q'))
+    terms = _MappedStrings(section('terms'), section('term_offsets', 'Q'))
+    return {
+        'version': INDEX_VERSION,
+        'normalizer': NORMALIZER_ID,
+        'repo': source_name,
+        'commit': header['commit'],
+        'formats': header['formats'],
+        'built_at': header['built_at'],
+        'tree': _MappedTree(paths, section('sizes', 'Q')),
+        'texts': _MappedTexts(paths),
+        'terms': terms,
+        'postings': _MappedPostings(terms, section('posting_offsets', 'Q'), section('postings', 'I')),
+        'words': _MappedWords(terms, section('words', 'I')),
+    }
+
+class NASSource(LocalSource):
+    """大型本地目录（如 NAS 上的仓库镜像）：只遍历一次，索引保存为内存映射文件
+
+    启动时只映射已有的索引文件，不重新遍历目录，也不把索引读入内存；
+    目录内容变化后用 rescan()（命令行 index --rescan）重建。
+    """
+
+    def __init__(self, name, root, timeout=SOURCE_TIMEOUT):
+        super().__init__(name, root, timeout)
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _index_file(self):
+        return os.path.join(INDEX_DIR, _cache_key(self.name) + '.nidx')
+
+    def _build(self):
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(self.root)
+        write_mapped_index(self._index_file(), self.name, self._walk())
+        return open_mapped_index(self._index_file(), self.name)
+
+    def load_index(self, max_age=TREE_CACHE_TTL):
+        with self._lock:
+            if self._index is None:
+                self._index = open_mapped_index(self._index_file(), self.name) or self._build()
+            return self._index
+
+    def local_index(self):
+        with self._lock:
+            if self._index is None:
+                self._index = open_mapped_index(self._index_file(), self.name)
+            return self._index
+
+    def rescan(self):
+        with self._lock:
+            self._index = self._build()
+            return self._index
+
+    def fetch_record(self, max_age=TREE_CACHE_TTL):
+        index = self.load_index()
+        return {
+            'repo': self.name,
+            'commit': index['commit'],
+            'etag': None,
+            'checked_at': index['built_at'],
+            'formats': index['formats'],
+            'tree': list(index['tree']),
+        }
+
+    def list(self):
+        return self.load_index()['tree']
+
+# OPDS 获取链接的 MIME 类型对应的格式
+OPDS_FORMATS = {
+    'application/epub+zip': '.epub',
+    'application/pdf': '.pdf',
+    'application/x-mobipocket-ebook': '.mobi',
+    'application/vnd.amazon.ebook': '.azw3',
+    'image/vnd.djvu': '.djvu',
+    'image/x-djvu': '.djvu',
+}
+_ATOM = '{http://www.w3.org/2005/Atom}'
+_OPENSEARCH = '{http://a9.com/-/spec/opensearch/1.1/}'
+
+class OPDSSource(Source):
+    """OPDS 目录，通过目录的 OpenSearch 接口实时搜索；path 为获取链接的完整 URL
+
+    目录通常没有完整的文件列表，因此不建立本地索引，结果也没有 sha。
+    """
+
+    indexed = False
+
+    def __init__(self, name, url, timeout=SOURCE_TIMEOUT):
+        super().__init__(name, timeout)
+        self.url = url
+        self._template = None
+
+    def _get_xml(self, url):
+        with open_url(url, timeout=self.timeout) as response:
+            return ElementTree.fromstring(response.read())
+
+    def _search_template(self):
+        """从目录根找到搜索地址模板（含 {searchTerms}）"""
+        if self._template:
+            return self._template
+        feed = self._get_xml(self.url)
+        for link in feed.iter(f'{_ATOM}link'):
+            if link.get('rel') != 'search':
+                continue
+            href = urllib.parse.urljoin(self.url, link.get('href', ''))
+            if '{searchTerms}' in href:
+                self._template = href
+                break
+            if 'opensearchdescription' in (link.get('type') or ''):
+                description = self._get_xml(href)
+                for template in description.iter(f'{_OPENSEARCH}Url'):
+                    if 'atom' in (template.get('type') or ''):
+                        self._template = urllib.parse.urljoin(href, template.get('template', ''))
+                        break
+                if self._template:
+                    break
+        if not self._template:
+            raise ValueError(f"{self.name} 不支持搜索")
+        return self._template
+
+    def list(self):
+        return []
+
+    def fetch_record(self, max_age=TREE_CACHE_TTL):
+        raise NotImplementedError(f"{self.name} 不提供文件列表")
+
+    def search(self, query, formats=None):
+        started = time.time()
+        formats = normalize_formats(formats) if formats else EBOOK_FORMATS
+        try:
+            # 去掉 {startPage?} 之类的可选参数
+            url = re.sub(r'\{[^}]*\?\}', '', self._search_template())
+            feed = self._get_xml(url.replace('{searchTerms}', urllib.parse.quote(query)))
+        except RateLimitError:
+            raise
+        except Exception as e:
+            record_repo_failure(self.name, e)
+            return []
+
+        keywords = split_keywords(query)
+        results = []
+        for entry in feed.iter(f'{_ATOM}entry'):
+            title = (entry.findtext(f'{_ATOM}title') or '').strip()
+            for link in entry.iter(f'{_ATOM}link'):
+                fmt = OPDS_FORMATS.get((link.get('type') or '').split(';')[0].strip())
+                bonus = format_bonus(fmt, formats)
+                if not title or bonus is None or not (link.get('rel') or '').startswith(
+                        'http://opds-spec.org/acquisition'):
+                    continue
+                name = sanitize_filename(title) + fmt
+                results.append({
+                    'name': name,
+                    'path': urllib.parse.urljoin(url, link.get('href', '')),
+                    'repository': {'full_name': self.name},
+                    'format': fmt,
+                    'score': score_path(name, keywords) + bonus,
+                })
+        results.sort(key=lambda result: result['score'], reverse=True)
+        # OPDS 每次搜索都访问网络，整个搜索的耗时即网络耗时
+        record_repo_result(self.name, len(results), query_language(query),
+                           time.time() - started, started)
+        return results
+
+    def file_url(self, path, commit=None):
+        return path
+
+SOURCE_TYPES = {
+    'github': GitHubSource,
+    'gitee': GiteeSource,
+    'gitlab': GitLabSource,
+    'local': LocalSource,
+    'nas': NASSource,
+    'opds': OPDSSource,
+}
+
+def make_source(config):
+    """根据配置项创建搜索源
+
+    例如 {"type": "gitee", "repo": "owner/name"}、{"type": "gitlab", "url": "https://git.example.com",
+    "repo": "group/project", "token": "..."}、{"type": "local", "path": "~/Books"}、
+    {"type": "nas", "path": "/Volumes/NAS/books"}、
+    {"type": "opds", "url": "https://example.com/opds"}；可选 name 和 timeout（秒）。
+    """
+    kind = config.get('type', 'github')
+    if kind not in SOURCE_TYPES:
+        raise ValueError(f"未知的搜索源类型: {kind}")
+    timeout = float(config.get('timeout', SOURCE_TIMEOUT))
+    if kind == 'github':
+        return GitHubSource(config['repo'], timeout)
+    if kind in ('gitee', 'gitlab'):
+        name = config.get('name') or f"{kind}:{config['repo']}"
+        return SOURCE_TYPES[kind](name, config['repo'], config.get('url'), config.get('token'), timeout)
+    if kind in ('local', 'nas'):
+        root = os.path.expanduser(config['path'])
+        return SOURCE_TYPES[kind](config.get('name') or f"{kind}:{root}", root, timeout)
+    url = config['url']
+    return OPDSSource(config.get('name') or f"opds:{urllib.parse.urlsplit(url).netloc}", url, timeout)
+
+def load_sources():
+    """内置的 GitHub 仓库，加上配置文件 sources 列表中的搜索源"""
+    sources = {repo: GitHubSource(repo) for repo in KNOWN_EBOOK_REPOS}
+    for config in load_config().get('sources', []):
+        try:
+            source = make_source(config)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"忽略无效的搜索源配置 {config}: {e}", file=sys.stderr)
+            continue
+        sources[source.name] = source
+    return sources
+
+_sources = load_sources()
+
+def source_names(indexed_only=False):
+    """全部搜索源的名称；indexed_only 时只包括可建立本地索引的源"""
+    return [name for name, source in _sources.items() if source.indexed or not indexed_only]
+
+def get_source(name):
+    """按名称查找搜索源，未配置的 owner/name 当作 GitHub 仓库"""
+    source = _sources.get(name)
+    return source if source is not None else GitHubSource(name)
+
+def search_source(name, query, formats=None):
+    """在一个搜索源中搜索"""
+    return get_source(name).search(query, formats)
+
+def source_timeout(name):
+    """搜索源的超时（秒）"""
+    return get_source(name).timeout
+
+# 批量下载的工作线程数
+QUEUE_WORKERS = 4
+# 对同一主机同时进行的下载数
+PER_HOST_LIMIT = 3
+
+class DownloadQueue:
+    """批量下载队列
+
+    任务在有界线程池中执行，同一主机的并发数受限（对每个镜像分别计算）。
+    连接中断由 stream_download 续传重试，其余失败依次换镜像，队列本身不再重试。
+    每个任务是一个状态字典，状态依次为 queued、downloading，
+    最终为 done 或 failed；状态变化时调用 on_status(任务)。
+    """
+
+    def __init__(self, dest_dir, max_workers=QUEUE_WORKERS, per_host=PER_HOST_LIMIT,
+                 connections=1, on_status=None):
+        self.dest_dir = dest_dir
+        self.max_workers = max_workers
+        self.per_host = per_host
+        # 批量下载时并行度来自多个任务，单个文件默认只用一个连接
+        self.connections = connections
+        self.on_status = on_status
+        self.items = []
+        self._names = set()
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def add(self, repo_name, path, filename=None, mirrors=None, sha=None, size=None, commit=None):
+        """加入一个下载任务，返回任务状态字典
+
+        mirrors 为内容相同的其他来源，失败时依次尝试；sha 和 size 用于查书库和校验，
+        commit 为搜索结果所在的提交。
+        """
+        filename = sanitize_filename(filename or os.path.basename(path))
+        stem, ext = os.path.splitext(filename)
+        suffix = repo_name.split('/')[-1]
+        counter = 1
+        with self._lock:
+            while filename in self._names:
+                # 同名文件加上仓库名，仍然重名时再加序号
+                filename = f"{stem} ({suffix}){ext}" if counter == 1 else f"{stem} ({suffix} {counter}){ext}"
+                counter += 1
+            self._names.add(filename)
+        item = {
+            'repo': repo_name,
+            'path': path,
+            'url': get_source(repo_name).file_url(path, commit),
+            'mirrors': mirrors or [{'repository': {'full_name': repo_name}, 'path': path, 'commit': commit}],
+            'sha': sha,
+            'size': size,
+            'dest': os.path.join(self.dest_dir, filename),
+            'status': 'queued',
+            'attempts': 0,
+            'error': None,
+        }
+        self.items.append(item)
+        return item
+
+    def add_results(self, results):
+        """加入一组搜索结果"""
+        for result in results:
+            self.add(result['repository']['full_name'], result['path'], result['name'],
+                     result_mirrors(result), result.get('sha'), result.get('size'), result.get('commit'))
+
+    def _set_status(self, item, status, error=None):
+        item['status'] = status
+        item['error'] = error
+        if self.on_status:
+            self.on_status(item)
+
+    def _host_slot(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.Semaphore(self.per_host)
+            return self._host_slots[host]
+
+    def _run_item(self, item):
+        item['attempts'] += 1
+        self._set_status(item, 'downloading')
+        try:
+            mirror = fetch_result(item, item['dest'], connections=self.connections,
+                                  host_slot=self._host_slot)
+        except Exception as e:
+            self._set_status(item, 'failed', str(e))
+            return
+        item.update(repo=mirror['repository']['full_name'], path=mirror['path'],
+                    url=get_source(mirror['repository']['full_name']).file_url(
+                        mirror['path'], mirror.get('commit')))
+        self._set_status(item, 'done')
+
+    def run(self):
+        """下载所有排队中的任务，完成后返回全部任务状态"""
+        os.makedirs(self.dest_dir, exist_ok=True)
+        pending = [item for item in self.items if item['status'] == 'queued']
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            list(executor.map(self._run_item, pending))
+        return self.items
+
 def sanitize_filename(name):
     """清理文件名"""
     return re.sub(r'[<>:"/\\|?*]', '', name)
 
+def search(query, repo_list=None, limit=MAX_RESULTS, formats=None, on_skip=None):
+    """搜索电子书，按相关度从高到低产出结果字典，不显示任何界面
+
+    结果字典包含 name、path、repository.full_name、sha 和 score，可直接传给 download()。
+    同一文件出现在多个仓库时只产出一次，mirrors 列出全部来源，下载时自动换源。
+    repo_list 为搜索源名称列表，默认为全部搜索源（内置仓库加上配置的 sources）。
+    limit 为 0 时扫描所有仓库并返回全部结果。formats 为按偏好排列的格式列表，默认 EBOOK_FORMATS。
+    因 API 配额不足推迟的仓库在等待时间不超过 RATE_LIMIT_MAX_WAIT 时等到配额窗口重置后再扫描，
+    否则跳过并调用 on_skip(仓库列表, RateLimitError)。
+    没有任何结果且有仓库因 API 配额用完未能搜索时抛出 RateLimitError。
+    """
+    pending = source_names() if repo_list is None else repo_list
+    top = TopResults(limit)
+    rate_limited = None
+    while pending:
+        repo_list, deferred = schedule_repos(pending, query)
+        scan = iter_scan(repo_list, query,
+                         lambda repo, book_name: search_source(repo, book_name, formats),
+                         timeout=source_timeout)
+        enough = False
+        try:
+            for event in scan:
+                if isinstance(event['error'], RateLimitError):
+                    deferred.append(event['repo'])
+                for result in event['results']:
+                    top.push(result)
+                if top.good_enough():
+                    enough = True
+                    break
+        finally:
+            scan.close()
+        if enough or not deferred:
+            break
+        if not _token_pool.wait_for_reset():
+            rate_limited = RateLimitError(_token_pool.reset)
+            if on_skip:
+                on_skip(deferred, rate_limited)
+            break
+        pending = deferred
+    # 没有结果且有仓库因配额用完未能搜索时抛出，避免被当成“未找到”
+    if rate_limited and not len(top):
+        raise rate_limited
+    for result in top.sorted():
+        yield result
+
+def download(result, dest, progress=None):
+    """下载一个搜索结果，dest 为目录或文件路径，返回保存的文件路径"""
+    if os.path.isdir(dest) or dest.endswith(os.sep):
+        os.makedirs(dest, exist_ok=True)
+        dest = os.path.join(dest, sanitize_filename(result['name']))
+    fetch_result(result, dest, progress)
+    return dest
+
+def download_all(results):
+    """把全部搜索结果批量下载到选定的文件夹"""
+    dest_dir = choose_folder("选择保存全部电子书的文件夹")
+    if not dest_dir:
+        return
+    
+    queue = DownloadQueue(dest_dir)
+    queue.add_results(results)
+    show_progress_notification("下载中", f"正在下载 {len(queue.items)} 本电子书")
+    items = queue.run()
+    
+    failed = [item for item in items if item['status'] == 'failed']
+    message = f"已保存 {len(items) - len(failed)} 本到:\n{dest_dir}"
+    if failed:
+        message += f"\n\n{len(failed)} 本下载失败:\n" + "\n".join(
+            os.path.basename(item['dest']) for item in failed[:5])
+    show_alert("下载完成", message, is_error=len(failed) == len(items))
+
 def main():
-    # 获取书名
-    book_name = show_input_dialog("📚 电子书下载器", "请输入要搜索的书名:")
+    if prefetch_enabled():
+        # 用户输入书名时在后台更新各仓库的文件列表
+        Prefetcher().start()
+    while True:
+        # 获取书名
+        book_name = show_input_dialog("📚 电子书下载器", "请输入要搜索的书名:")
+        
+        if not book_name:
+            sys.exit(0)
+        
+        # 搜索（会显示进度窗口）
+        results = search_github(book_name)
+        
+        if not results:
+            if ask_yes_no("未找到", "未找到相关电子书\n\n建议：\n• 尝试更简短的关键词\n• 使用书名中的核心词\n\n是否重新搜索？"):
+                continue
+            return
+        
+        # 显示结果列表，第一项为批量下载
+        download_all_item = f"⬇️ 全部下载 ({len(results)} 本)"
+        items = []
+        for item in results:
+            name = item['name']
+            repo = item['repository']['full_name'].split('/')[-1]
+            mirror_count = len(result_mirrors(item)) - 1
+            display = f"{name} ({repo} +{mirror_count} 镜像)" if mirror_count else f"{name} ({repo})"
+            # AppleScript 列表项长度限制，截断
+            if len(display) > 60:
+                display = display[:57] + "..."
+            items.append(display)
+        
+        selected = show_list_dialog(
+            "搜索结果",
+            f"找到 {len(results)} 本电子书，请选择:",
+            [download_all_item] + items
+        )
+        
+        if not selected:
+            sys.exit(0)
+        
+        if selected == download_all_item:
+            download_all(results)
+        else:
+            # 找到选中的索引
+            idx = items.index(selected)
+            item = results[idx]
+            
+            filename = sanitize_filename(item['name'])
+            
+            # 选择保存位置
+            save_path = choose_save_location(filename)
+            
+            if not save_path:
+                sys.exit(0)
+            
+            # 确保扩展名与所选文件的格式一致
+            ext = os.path.splitext(item['name'])[1]
+            if ext and not save_path.lower().endswith(ext.lower()):
+                save_path += ext
+            
+            # 下载
+            if not download_file(item, save_path):
+                return
+            if ask_yes_no("下载完成", f"已保存到:\n{save_path}\n\n是否立即打开?"):
+                subprocess.run(['open', save_path])
+        
+        # 询问是否继续搜索
+        if not ask_yes_no("继续", "是否继续搜索其他书籍?"):
+            return
+
+def _read_results(stream):
+    """从 JSON Lines 中读取搜索结果"""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def _show_live_results(query, results, elapsed, engine):
+    """在终端上重绘边输入边搜索的界面（写到标准错误，标准输出留给最终结果）"""
+    lines = ["\x1b[H\x1b[2J", f"搜索 ({len(engine.indexes)} 个已缓存的仓库): {query}\r\n"]
+    if query.strip():
+        lines.append(f"  {len(results)} 个结果，{elapsed * 1000:.1f} ms\r\n")
+    for result in results:
+        lines.append(f"  {result['name']}  ({result['repository']['full_name']})\r\n")
+    lines.append("\r\n回车输出结果，Esc 退出")
+    sys.stderr.write(''.join(lines))
+    sys.stderr.flush()
+
+def live_search(limit=10, formats=None):
+    """命令行边输入边搜索，回车后把当前结果输出到标准输出并返回结果列表"""
+    engine = IncrementalSearch(limit=limit, formats=formats)
+    if not engine.indexes:
+        print("没有本地索引，请先运行 index 命令", file=sys.stderr)
+        return None
+    if termios is None or not sys.stdin.isatty():
+        # 不是终端时按行读取，每行作为一次完整输入
+        results = []
+        for line in sys.stdin:
+            results = engine.update(line.strip())
+        return results
+
+    fd = sys.stdin.fileno()
+    saved = termios.tcgetattr(fd)
+    query = ''
+    results = []
+    try:
+        tty.setcbreak(fd)
+        _show_live_results(query, results, 0, engine)
+        while True:
+            char = sys.stdin.read(1)
+            if char in ('\r', '\n'):
+                break
+            if char in ('\x1b', '\x03', '\x04', ''):
+                results = None
+                break
+            if char in ('\x7f', '\b'):
+                query = query[:-1]
+            elif char.isprintable():
+                query += char
+            else:
+                continue
+            started = time.perf_counter()
+            results = engine.update(query)
+            _show_live_results(query, results, time.perf_counter() - started, engine)
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+        sys.stderr.write("\x1b[H\x1b[2J")
+    return results
+
+def cli(argv=None):
+    """命令行入口；不带参数时启动对话框界面"""
+    global RATE_LIMIT_MAX_WAIT
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        main()
+        return 0
     
-    if not book_name:
-        sys.exit(0)
+    parser = argparse.ArgumentParser(
+        prog='book_downloader.py',
+        description='搜索并下载 GitHub 电子书仓库中的电子书；不带参数运行时显示图形界面')
+    commands = parser.add_subparsers(dest='command')
     
-    # 搜索（会显示进度窗口）
-    results = search_github(book_name)
+    search_cmd = commands.add_parser('search', help='搜索电子书')
+    search_cmd.add_argument('query', help='书名或关键词')
+    search_cmd.add_argument('-n', '--limit', type=int, default=MAX_RESULTS,
+                            help=f'最多返回的结果数，0 表示不限（默认 {MAX_RESULTS}）')
+    search_cmd.add_argument('--json', action='store_true', help='每行输出一个 JSON 结果')
+    search_cmd.add_argument('-f', '--format', dest='formats',
+                            help='只搜索这些格式，按偏好排列，逗号分隔（如 pdf,epub）')
+    search_cmd.add_argument('--wait', action='store_true',
+                            help='API 配额用完时排队等待窗口重置，而不是放弃')
     
-    if not results:
-        if ask_yes_no("未找到", "未找到相关电子书\n\n建议：\n• 尝试更简短的关键词\n• 使用书名中的核心词\n\n是否重新搜索？"):
-            main()
-        return
+    download_cmd = commands.add_parser('download', help='下载电子书')
+    download_cmd.add_argument('repo', help='仓库或搜索源名称，如 owner/name；为 - 时从标准输入读取 search --json 的结果')
+    download_cmd.add_argument('path', nargs='?', help='文件在仓库中的路径')
+    download_cmd.add_argument('-o', '--dest', default='.', help='保存目录或文件路径（默认当前目录）')
+    download_cmd.add_argument('--json', action='store_true', help='每行输出一个 JSON 状态')
     
-    # 显示结果列表
-    items = []
-    for item in results:
-        name = item['name']
-        repo = item['repository']['full_name'].split('/')[-1]
-        display = f"{name} ({repo})"
-        # AppleScript 列表项长度限制，截断
-        if len(display) > 60:
-            display = display[:57] + "..."
-        items.append(display)
+    live_cmd = commands.add_parser('live', help='只在本地索引中边输入边搜索，不访问网络')
+    live_cmd.add_argument('-n', '--limit', type=int, default=10, help='显示的结果数（默认 10）')
+    live_cmd.add_argument('--json', action='store_true', help='每行输出一个 JSON 结果')
+    live_cmd.add_argument('-f', '--format', dest='formats',
+                          help='只搜索这些格式，按偏好排列，逗号分隔（如 pdf,epub）')
     
-    selected = show_list_dialog(
-        "搜索结果",
-        f"找到 {len(results)} 本电子书，请选择:",
-        items
-    )
+    daemon_cmd = commands.add_parser('daemon', help='在前台持续预取各仓库的文件列表，保持本地索引为最新')
+    daemon_cmd.add_argument('--interval', type=float, default=PREFETCH_INTERVAL,
+                            help=f'检查间隔（秒，默认 {PREFETCH_INTERVAL:g}）')
     
-    if not selected:
-        sys.exit(0)
+    index_cmd = commands.add_parser('index', help='为所有已知仓库建立本地索引')
+    index_cmd.add_argument('--rescan', action='store_true',
+                           help='重新检查所有源并重建索引（本地目录和 NAS 会重新遍历）')
+    commands.add_parser('rate', help='查看 GitHub API 剩余配额')
     
-    # 找到选中的索引
-    idx = items.index(selected)
-    item = results[idx]
+    args = parser.parse_args(argv)
     
-    # 获取下载链接
-    repo = item['repository']['full_name']
-    path = item['path']
-    download_url = f"https://github.com/{repo}/raw/HEAD/{urllib.parse.quote(path)}"
+    if args.command == 'search':
+        if args.wait:
+            RATE_LIMIT_MAX_WAIT = float('inf')
+        found = 0
+        try:
+            formats = args.formats.split(',') if args.formats else None
+            def on_skip(repos, error):
+                print(f"{error}，未搜索 {len(repos)} 个仓库: {', '.join(repos)}（可加 --wait 等待）",
+                      file=sys.stderr)
+            for result in search(args.query, limit=args.limit, formats=formats, on_skip=on_skip):
+                found += 1
+                if args.json:
+                    print(json.dumps(result, ensure_ascii=False), flush=True)
+                else:
+                    print(f"{result['repository']['full_name']}\t{result['path']}", flush=True)
+        except RateLimitError as e:
+            print(e, file=sys.stderr)
+            return 3
+        return 0 if found else 1
     
-    filename = sanitize_filename(item['name'])
+    if args.command == 'download':
+        if args.repo == '-':
+            queue = DownloadQueue(args.dest)
+            queue.add_results(_read_results(sys.stdin))
+            items = queue.run()
+        else:
+            if not args.path:
+                parser.error('download 需要仓库名和文件路径')
+            item = {'repo': args.repo, 'path': args.path, 'status': 'done', 'error': None}
+            try:
+                item['dest'] = download({
+                    'name': os.path.basename(args.path),
+                    'path': args.path,
+                    'repository': {'full_name': args.repo},
+                }, args.dest)
+            except Exception as e:
+                item.update(dest=args.dest, status='failed', error=str(e))
+            items = [item]
+        for item in items:
+            if args.json:
+                print(json.dumps({key: item[key] for key in ('repo', 'path', 'dest', 'status', 'error')},
+                                 ensure_ascii=False))
+            elif item['status'] == 'done':
+                print(item['dest'])
+            else:
+                print(f"下载失败: {item['repo']}/{item['path']}: {item['error']}", file=sys.stderr)
+        return 0 if all(item['status'] == 'done' for item in items) else 1
     
-    # 选择保存位置
-    save_path = choose_save_location(filename)
+    if args.command == 'live':
+        results = live_search(args.limit, args.formats.split(',') if args.formats else None)
+        for result in results or ():
+            if args.json:
+                print(json.dumps(result, ensure_ascii=False))
+            else:
+                print(f"{result['repository']['full_name']}\t{result['path']}")
+        return 0 if results else 1
     
-    if not save_path:
-        sys.exit(0)
+    if args.command == 'daemon':
+        prefetcher = Prefetcher(interval=args.interval,
+                                on_update=lambda repo, index: print(f"已更新 {repo} ({index['commit'][:7]})",
+                                                                    flush=True))
+        try:
+            prefetcher.run_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
     
-    # 确保扩展名
-    if not save_path.endswith('.epub'):
-        save_path += '.epub'
+    if args.command == 'index':
+        built = build_index(rescan=args.rescan)
+        print(f"已索引 {built}/{len(source_names(indexed_only=True))} 个仓库")
+        return 0 if built else 1
     
-    # 下载
-    if download_file(download_url, save_path):
-        if ask_yes_no("下载完成", f"已保存到:\n{save_path}\n\n是否立即打开?"):
-            subprocess.run(['open', save_path])
-        
-        # 询问是否继续搜索
-        if ask_yes_no("继续", "是否继续搜索其他书籍?"):
-            main()
+    if args.command == 'rate':
+        try:
+            # /rate_limit 本身不消耗配额
+            with open_url(f"{GITHUB_API}/rate_limit") as response:
+                response.read()
+        except RateLimitError:
+            pass
+        except (OSError, http.client.HTTPException) as e:
+            # 网络不通等错误（HTTPError、URLError、socket.gaierror 都是 OSError）
+            print(f"无法获取 GitHub API 配额: {e}", file=sys.stderr)
+            return 1
+        status = get_rate_limit()
+        print(json.dumps(status))
+        return 0
+    
+    parser.print_help()
+    return 2
 
 if __name__ == "__main__":
-    main()
+    sys.exit(cli())